@@ -1,10 +1,15 @@
+import functools
+import os
+import random
 from pathlib import Path
+from typing import Optional
 
-from lib.storage.dto import *
-
-import attrs
 from flask import Flask, jsonify, request, Response
-from sqlite_integrated import *
+
+from lib.ResultCache import ResultCache
+from lib.storage.checkpoint import DATA_VERSION_KEY
+from lib.storage.connection import ReadOnlyConnectionPool
+from lib.storage.schema import AUTHOR_REPO_STATS_TABLE, AUTHOR_STATS_TABLE, COMMIT_TABLE, CRAWL_STATE_TABLE
 
 
 environment_variables = os.environ.copy()
@@ -13,10 +18,82 @@ DATABASE_DIR = environment_variables.get("DATABASE_DIR", None)
 DATABASE_PATH = Path(os.getcwd()).joinpath(DATABASE_DIR)
 DATABASE_FILE = os.path.join(DATABASE_PATH, "database.db")
 
+API_DB_POOL_SIZE = int(environment_variables.get('API_DB_POOL_SIZE', '8'))
+DB_BUSY_TIMEOUT_MS = int(environment_variables.get('DB_BUSY_TIMEOUT_MS', '5000'))
+API_DEFAULT_PAGE_SIZE = int(environment_variables.get('API_DEFAULT_PAGE_SIZE', '100'))
+API_MAX_PAGE_SIZE = int(environment_variables.get('API_MAX_PAGE_SIZE', '1000'))
+API_MAX_SAMPLE_SIZE = int(environment_variables.get('API_MAX_SAMPLE_SIZE', '100'))
+API_CACHE_ENTRIES = int(environment_variables.get('API_CACHE_ENTRIES', '1024'))
+API_CACHE_TTL_S = float(environment_variables.get('API_CACHE_TTL_S', '300'))
+API_AUTHORS_DEFAULT_LIMIT = int(environment_variables.get('API_AUTHORS_DEFAULT_LIMIT', '10'))
+API_AUTHORS_MAX_LIMIT = int(environment_variables.get('API_AUTHORS_MAX_LIMIT', '100'))
+
+COMMIT_FIELDS = [
+    'hash',
+    'message',
+    'summary',
+    'date',
+    'author',
+    'email',
+    'diff_link',
+    'repo_url']
+
+AUTHOR_FIELDS = [
+    'email',
+    'author',
+    'commits',
+    'repos',
+    'first_commit_date',
+    'last_commit_date']
+
 app = Flask(__name__)
+pool = ReadOnlyConnectionPool(DATABASE_FILE, size=API_DB_POOL_SIZE, busy_timeout_ms=DB_BUSY_TIMEOUT_MS)
+result_cache = ResultCache(max_entries=API_CACHE_ENTRIES, ttl_s=API_CACHE_TTL_S)
+
+
+def data_version() -> Optional[str]:
+    try:
+        with pool.connection() as conn:
+            row = conn.execute(f'SELECT value FROM {CRAWL_STATE_TABLE} WHERE key = ?', (DATA_VERSION_KEY,)).fetchone()
+    except Exception:
+        return None
+    return None if row is None else row[0]
+
+
+def cached_json(handler):
+    @functools.wraps(handler)
+    def wrapper():
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        version = data_version()
+        body = result_cache.get(key, version)
+        if body is None:
+            resp = handler()
+            if resp.status_code != 200:
+                return resp
+            body = resp.get_data()
+            result_cache.put(key, version, body)
+        return Response(body, status=200, mimetype='application/json')
+
+    return wrapper
+
+
+def parse_fields(fields_param: str) -> list:
+    if fields_param is None or fields_param.strip() == '':
+        return COMMIT_FIELDS
+    fields = [f.strip() for f in fields_param.split(',') if f.strip() != '']
+    unknown_fields = [f for f in fields if f not in COMMIT_FIELDS]
+    if len(unknown_fields) > 0:
+        raise ValueError(f"Unknown fields: {','.join(unknown_fields)}. Possible fields: {','.join(COMMIT_FIELDS)}")
+    return fields
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'data': result_cache.stats(), 'data_version': data_version()})
 
 
 @app.route('/api/commits/by/author', methods=['GET'])
+@cached_json
 def disp():
     email = request.args.get('email')
     if email is None:
@@ -24,30 +101,137 @@ def disp():
         return resp
 
     try:
-        db = Database(DATABASE_FILE, new=False)
+        fields = parse_fields(request.args.get('fields'))
+        limit = int(request.args.get('limit', API_DEFAULT_PAGE_SIZE))
+        cursor = int(request.args.get('cursor', 0))
+        if limit < 1 or limit > API_MAX_PAGE_SIZE:
+            raise ValueError(f"Parameter 'limit' must be between 1 and {API_MAX_PAGE_SIZE}")
+    except ValueError as e:
+        return Response(str(e), status=400)
 
-        fields = [
-            'hash',
-            'message',
-            'summary',
-            'date',
-            'author',
-            'email',
-            'diff_link',
-            'repo_url']
-        commits_by_email = db.cursor.execute(
-            f'SELECT {",".join(fields)} FROM commits WHERE email LIKE "{email}"').fetchall()
+    try:
+        # Emails are stored lower case; the email index is walked in id order after the cursor
+        with pool.connection() as conn:
+            rows = conn.execute(
+                f'SELECT id, {",".join(fields)} FROM {COMMIT_TABLE} WHERE email = ? AND id > ? ORDER BY id LIMIT ?',
+                (email.strip().lower(), cursor, limit + 1)
+            ).fetchall()
     except Exception:
         resp = Response("An error occurred finding commits by email", status=500)
         return resp
 
-    if len(commits_by_email) == 0:
-        return jsonify({'data': []})
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = str(rows[-1][0])
+
+    commits = [dict(zip(fields, row[1:])) for row in rows]
+    return jsonify({'data': commits, 'next_cursor': next_cursor})
+
+
+@app.route('/api/repos/by/author', methods=['GET'])
+@cached_json
+def repos_by_author():
+    email = request.args.get('email')
+    if email is None:
+        return Response("Required parameter 'email' not set", status=400)
+
+    try:
+        with pool.connection() as conn:
+            rows = conn.execute(
+                f'SELECT repo_url, commits, first_commit_date, last_commit_date FROM {AUTHOR_REPO_STATS_TABLE} '
+                f'WHERE email = ? ORDER BY repo_url',
+                (email.strip().lower(),)
+            ).fetchall()
+    except Exception:
+        return Response("An error occurred finding repos by email", status=500)
+
+    repos = [{'repo_url': repo_url, 'name': repo_url.rstrip('/').split('/')[-1], 'commits': commit_count,
+              'first_commit_date': first_commit_date, 'last_commit_date': last_commit_date}
+             for repo_url, commit_count, first_commit_date, last_commit_date in rows]
+    return jsonify({'data': repos})
+
+
+@app.route('/api/authors', methods=['GET'])
+@cached_json
+def authors():
+    prefix = request.args.get('prefix', '').strip().lower()
+
+    try:
+        limit = int(request.args.get('limit', API_AUTHORS_DEFAULT_LIMIT))
+        if limit < 1 or limit > API_AUTHORS_MAX_LIMIT:
+            raise ValueError(f"Parameter 'limit' must be between 1 and {API_AUTHORS_MAX_LIMIT}")
+    except ValueError as e:
+        return Response(str(e), status=400)
+
+    try:
+        with pool.connection() as conn:
+            where, args = prefix_range('email', prefix)
+            rows = conn.execute(
+                f'SELECT {",".join(AUTHOR_FIELDS)} FROM {AUTHOR_STATS_TABLE} {where} ORDER BY email LIMIT ?',
+                args + (limit,)
+            ).fetchall()
+    except Exception:
+        return Response("An error occurred finding authors", status=500)
+
+    return jsonify({'data': [dict(zip(AUTHOR_FIELDS, row)) for row in rows]})
+
+
+def prefix_range(column: str, prefix: str) -> tuple:
+    # A range on the column's index rather than LIKE, which SQLite only turns into a seek under case_sensitive_like
+    if prefix == '':
+        return '', ()
+    return f'WHERE {column} >= ? AND {column} < ?', (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+
+@app.route('/api/commits/random', methods=['GET'])
+def random_commits():
+    email = request.args.get('email')
+    repo_url = request.args.get('repo_url')
+    if email is None or repo_url is None:
+        return Response("Required parameters 'email' and 'repo_url' not set", status=400)
+
+    try:
+        fields = parse_fields(request.args.get('fields'))
+        n = int(request.args.get('n', 1))
+        if n < 1 or n > API_MAX_SAMPLE_SIZE:
+            raise ValueError(f"Parameter 'n' must be between 1 and {API_MAX_SAMPLE_SIZE}")
+    except ValueError as e:
+        return Response(str(e), status=400)
+
+    key = (email.strip().lower(), repo_url)
+    try:
+        with pool.connection() as conn:
+            commit_ids = sample_commit_ids(conn, key, n)
+            rows = []
+            if len(commit_ids) > 0:
+                placeholders = ",".join("?" for _ in commit_ids)
+                rows = conn.execute(
+                    f'SELECT {",".join(fields)} FROM {COMMIT_TABLE} WHERE id IN ({placeholders})', commit_ids
+                ).fetchall()
+    except Exception:
+        return Response("An error occurred sampling commits", status=500)
+
+    commits = [dict(zip(fields, row)) for row in rows]
+    random.shuffle(commits)
+    return jsonify({'data': commits})
+
 
-    typed_commits = list(map(lambda c: attrs.asdict(
-        Commit(hash=c[0], message=c[1],summary=c[2], date=c[3], author=c[4], email=c[5], diff_link=c[6], repo_url=c[7])), commits_by_email))
+def sample_commit_ids(conn, key: tuple, n: int) -> list:
+    # Commits of an author in a repo are numbered 1..count by seq, so distinct uniform numbers in that range are
+    # a uniform sample, each one a seek into the (email, repo_url, seq) index
+    row = conn.execute(
+        f'SELECT commits FROM {AUTHOR_REPO_STATS_TABLE} WHERE email = ? AND repo_url = ?', key
+    ).fetchone()
+    if row is None or row[0] < 1:
+        return []
 
-    return jsonify({'data': typed_commits})
+    seqs = random.sample(range(1, row[0] + 1), min(n, row[0]))
+    placeholders = ",".join("?" for _ in seqs)
+    rows = conn.execute(
+        f'SELECT id FROM {COMMIT_TABLE} WHERE email = ? AND repo_url = ? AND seq IN ({placeholders})', key + tuple(seqs)
+    ).fetchall()
+    return [commit_id for (commit_id,) in rows]
 
 
 # driver function
@@ -0,0 +1,148 @@
+"""
+Runs main.py against the fake Bitbucket server and reports throughput, requests and peak
+memory, so crawler regressions show up without touching api.bitbucket.org.
+
+Usage: python benchmarks/crawl_benchmark.py [--repos 50] [--commits 500] [--runs 1] [--json results.json]
+                                            [--env CRAWL_CONCURRENCY=4 ...] [--server-arg=--throttle-every=50 ...]
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CRAWLER_DIR = os.path.dirname(BENCHMARK_DIR)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fetch_stats(base_url: str, reset: bool = False) -> dict:
+    url = f"{base_url}/stats/reset" if reset else f"{base_url}/stats"
+    with urllib.request.urlopen(urllib.request.Request(url, method="POST" if reset else "GET"), timeout=5) as r:
+        return json.loads(r.read())
+
+
+def start_server(args, port: int) -> subprocess.Popen:
+    command = [
+        sys.executable, os.path.join(BENCHMARK_DIR, "fake_bitbucket.py"), "--port", str(port),
+        "--repos", str(args.repos), "--branches", str(args.branches), "--commits", str(args.commits),
+        "--latency-ms", str(args.latency_ms), *args.server_arg
+    ]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            fetch_stats(base_url)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Fake Bitbucket server did not start")
+
+
+def table_counts(database_file: str) -> dict:
+    conn = sqlite3.connect(database_file)
+    try:
+        return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ("repos", "branches", "commits")}
+    finally:
+        conn.close()
+
+
+def run_crawl(args, port: int, database_dir: str, log) -> dict:
+    base_url = f"http://127.0.0.1:{port}"
+    fetch_stats(base_url, reset=True)
+
+    environment = dict(
+        os.environ,
+        BITBUCKET_USERNAME="benchmark",
+        BITBUCKET_PASSWORD="benchmark",
+        DATABASE_DIR=database_dir,
+        BITBUCKET_API_URL=f"{base_url}/2.0",
+        REQUEST_PAGE_SIZE=str(args.page_size),
+        COMMIT_PAGE_LIMIT="0",
+        BRANCH_PAGE_LIMIT="0",
+        MAIN_BRANCH_ONLY="false",
+        RATE_LIMIT_PER_HOUR="100000000",
+    )
+    for assignment in args.env:
+        key, _, value = assignment.partition("=")
+        environment[key] = value
+
+    started = time.perf_counter()
+    crawler = subprocess.Popen([sys.executable, "main.py"], cwd=CRAWLER_DIR, env=environment,
+                               stdout=log, stderr=subprocess.STDOUT)
+    # wait4 reports the peak RSS of this crawler alone, RUSAGE_CHILDREN would include earlier runs
+    _, status, usage = os.wait4(crawler.pid, 0)
+    elapsed_s = time.perf_counter() - started
+    crawler.returncode = os.waitstatus_to_exitcode(status)
+
+    stats = fetch_stats(base_url)
+    counts = table_counts(os.path.join(database_dir, "database.db"))
+    return {
+        "exit_code": crawler.returncode,
+        "elapsed_s": round(elapsed_s, 3),
+        "repos": counts["repos"],
+        "branches": counts["branches"],
+        "commits": counts["commits"],
+        "repos_per_s": round(counts["repos"] / elapsed_s, 2),
+        "commits_per_s": round(counts["commits"] / elapsed_s, 2),
+        "requests": stats["requests"],
+        "throttled": stats["throttled"],
+        "not_modified": stats["not_modified"],
+        # ru_maxrss is in KiB on Linux; with CRAWL_SHARDS only the largest process counts
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark main.py against the fake Bitbucket server")
+    parser.add_argument("--repos", type=int, default=50)
+    parser.add_argument("--branches", type=int, default=3)
+    parser.add_argument("--commits", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--runs", type=int, default=1, help="crawls into the same database, later runs are re-crawls")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="environment variable for main.py, may be repeated")
+    parser.add_argument("--server-arg", action="append", default=[], help="extra fake_bitbucket.py argument")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--log", help="write the crawler output to this file instead of discarding it")
+    args = parser.parse_args()
+
+    port = free_port()
+    server = start_server(args, port)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="crawl-benchmark-") as database_dir, \
+                open(args.log or os.devnull, "w") as log:
+            for run in range(1, args.runs + 1):
+                result = run_crawl(args, port, database_dir, log)
+                result["run"] = run
+                results.append(result)
+                print(f"run {run}: {result['elapsed_s']:.1f}s, {result['repos_per_s']} repos/s, "
+                      f"{result['commits_per_s']} commits/s, {result['requests']} requests "
+                      f"({result['throttled']} throttled, {result['not_modified']} not modified), "
+                      f"peak RSS {result['peak_rss_mb']} MB, exit code {result['exit_code']}")
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+    sys.exit(max(r["exit_code"] for r in results) if results else 1)
+
+
+if __name__ == "__main__":
+    main()
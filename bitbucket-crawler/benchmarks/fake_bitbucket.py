@@ -0,0 +1,271 @@
+"""
+Stand-in for the parts of the Bitbucket 2.0 API the crawler uses, serving synthetic,
+deterministic data so crawls can be measured without spending quota.
+
+Usage: python benchmarks/fake_bitbucket.py [--repos 50] [--branches 3] [--commits 500] [--latency-ms 20]
+       then run main.py with BITBUCKET_API_URL=http://127.0.0.1:5999/2.0
+
+Supports pagination, include/exclude (branch names or commit hashes) on commits and the fields= selector.
+GET /stats returns the request counts, POST /stats/reset clears them.
+"""
+import argparse
+import functools
+import hashlib
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+
+settings = argparse.Namespace()
+stats = {"requests": 0, "throttled": 0, "not_modified": 0}
+stats_lock = threading.Lock()
+
+EPOCH = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+
+def commit_hash(*parts) -> str:
+    return hashlib.sha1("/".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+def repo_name(index: int) -> str:
+    return f"repo-{index:04d}"
+
+
+def workspace_of(index: int) -> str:
+    return f"workspace-{index % settings.workspaces}"
+
+
+def repo_index(workspace: str, name: str) -> Optional[int]:
+    try:
+        index = int(name.split("-")[-1])
+    except ValueError:
+        return None
+    if index >= settings.repos or workspace_of(index) != workspace:
+        return None
+    return index
+
+
+def branch_names() -> List[str]:
+    return [settings.main_branch] + [f"feature-{b}" for b in range(1, settings.branches)]
+
+
+@functools.lru_cache(maxsize=256)
+def history(index: int, branch: str) -> List[dict]:
+    # The main branch has settings.commits commits, every other branch adds settings.branch_commits on top
+    main_commits = [(commit_hash(index, i), i) for i in reversed(range(settings.commits))]
+    if branch == settings.main_branch:
+        return [commit(index, h, i) for h, i in main_commits]
+    unique = [(commit_hash(index, branch, i), settings.commits + i) for i in reversed(range(settings.branch_commits))]
+    return [commit(index, h, i) for h, i in unique + main_commits]
+
+
+def commit(index: int, hash_: str, i: int) -> dict:
+    name, workspace = repo_name(index), workspace_of(index)
+    author = i % settings.authors
+    message = f"Change {i} of {name}\n\n" + "Details of the change. " * settings.message_words
+    return {
+        "type": "commit",
+        "hash": hash_,
+        "date": (EPOCH + timedelta(minutes=index * 7 + i)).isoformat(),
+        "author": {"type": "author", "raw": f"Developer {author} <Developer{author}@example.com>"},
+        "message": message,
+        "summary": {"type": "rendered", "raw": message, "markup": "markdown", "html": f"<p>{message}</p>"},
+        "links": {
+            "self": {"href": f"{settings.api_url}/repositories/{workspace}/{name}/commit/{hash_}"},
+            "html": {"href": f"https://bitbucket.example.com/{workspace}/{name}/commits/{hash_}"},
+        },
+        "parents": [],
+        "repository": {
+            "type": "repository",
+            "full_name": f"{workspace}/{name}",
+            "name": name,
+            "links": {"html": {"href": f"https://bitbucket.example.com/{workspace}/{name}"}},
+        },
+    }
+
+
+def repo(index: int) -> dict:
+    name, workspace = repo_name(index), workspace_of(index)
+    return {
+        "type": "repository",
+        "name": name,
+        "full_name": f"{workspace}/{name}",
+        "workspace": {"type": "workspace", "slug": workspace},
+        "mainbranch": {"type": "branch", "name": settings.main_branch},
+        "updated_on": (EPOCH + timedelta(hours=index)).isoformat(),
+        "links": {"html": {"href": f"https://bitbucket.example.com/{workspace}/{name}"}},
+    }
+
+
+def select_fields(value, tree):
+    if tree is True:
+        return value
+    if isinstance(value, list):
+        return [select_fields(v, tree) for v in value]
+    if isinstance(value, dict):
+        return {k: select_fields(value[k], sub) for k, sub in tree.items() if k in value}
+    return value
+
+
+def field_tree(fields: str) -> dict:
+    # "next,values.links.html.href" -> {"next": True, "values": {"links": {"html": {"href": True}}}}
+    tree: dict = {}
+    for path in (f.strip() for f in fields.split(",")):
+        node = tree
+        parts = path.split(".")
+        for part in parts[:-1]:
+            child = node.setdefault(part, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[parts[-1]] = True
+    return tree
+
+
+def paginate(values: list, url: str, extra_params: str = "") -> dict:
+    pagelen = int(request.args.get("pagelen", 10))
+    page = int(request.args.get("page", 1))
+    data = {"pagelen": pagelen, "page": page, "size": len(values),
+            "values": values[(page - 1) * pagelen:page * pagelen]}
+    fields = request.args.get("fields")
+    if fields:
+        extra_params += f"&fields={fields}"
+    if page * pagelen < len(values):
+        data["next"] = f"{url}?pagelen={pagelen}&page={page + 1}{extra_params}"
+    # Partial responses like Bitbucket's fields= selector
+    return select_fields(data, field_tree(fields)) if fields else data
+
+
+@app.before_request
+def before():
+    if request.path.startswith("/stats"):
+        return None
+    with stats_lock:
+        stats["requests"] += 1
+        throttle = settings.throttle_every > 0 and stats["requests"] % settings.throttle_every == 0
+        if throttle:
+            stats["throttled"] += 1
+    if settings.latency_ms > 0:
+        time.sleep(random.uniform(0.5, 1.5) * settings.latency_ms / 1000)
+    if throttle:
+        return jsonify({"type": "error", "error": {"message": "Rate limit exceeded"}}), 429, {
+            "Retry-After": str(settings.retry_after_s)
+        }
+    return None
+
+
+@app.after_request
+def after(response):
+    if request.path.startswith("/stats"):
+        return response
+    response.headers["X-RateLimit-Limit"] = str(settings.rate_limit)
+    response.headers["X-RateLimit-Remaining"] = str(max(0, settings.rate_limit - stats["requests"]))
+    if response.status_code == 200 and response.is_json:
+        response.add_etag()
+        response.make_conditional(request)
+        if response.status_code == 304:
+            with stats_lock:
+                stats["not_modified"] += 1
+    return response
+
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    with stats_lock:
+        return jsonify(dict(stats))
+
+
+@app.route("/stats/reset", methods=["POST"])
+def reset_stats():
+    with stats_lock:
+        for key in stats:
+            stats[key] = 0
+        return jsonify(dict(stats))
+
+
+@app.route("/2.0/repositories", methods=["GET"])
+def repositories():
+    # Sorted by -updated_on like the crawler asks for; the after parameter is passed along but not applied
+    repos = [repo(i) for i in reversed(range(settings.repos))]
+    after_param = request.args.get("after")
+    extra_params = "" if after_param is None else f"&after={after_param}"
+    return jsonify(paginate(repos, f"{settings.api_url}/repositories", extra_params))
+
+
+@app.route("/2.0/repositories/<workspace>/<name>/refs", methods=["GET"])
+@app.route("/2.0/repositories/<workspace>/<name>/refs/branches", methods=["GET"])
+def refs(workspace: str, name: str):
+    index = repo_index(workspace, name)
+    if index is None:
+        return jsonify({"type": "error", "error": {"message": "Repository not found"}}), 404
+    branches = [{
+        "type": "branch",
+        "name": branch,
+        "target": {"type": "commit", "hash": history(index, branch)[0]["hash"]},
+        "links": {"html": {"href": f"https://bitbucket.example.com/{workspace}/{name}/branch/{branch}"}},
+    } for branch in branch_names()]
+    return jsonify(paginate(branches, f"{settings.api_url}/repositories/{workspace}/{name}/refs"))
+
+
+@app.route("/2.0/repositories/<workspace>/<name>/commits", methods=["GET"])
+@app.route("/2.0/repositories/<workspace>/<name>/commits/<path:branch>", methods=["GET"])
+def commits(workspace: str, name: str, branch: Optional[str] = None):
+    index = repo_index(workspace, name)
+    include = branch or request.args.get("include")
+    if index is None or include not in branch_names():
+        return jsonify({"type": "error", "error": {"message": "Not found"}}), 404
+
+    excluded = set()
+    for ref in request.args.getlist("exclude"):
+        if ref in branch_names():
+            excluded.update(c["hash"] for c in history(index, ref))
+        else:
+            # A commit hash: histories are linear, so its ancestors are everything listed after it
+            if not any(c["hash"] == ref for b in branch_names() for c in history(index, b)):
+                return jsonify({"type": "error", "error": {"message": f"Commit {ref} not found"}}), 404
+            hashes = [c["hash"] for c in history(index, include)]
+            if ref in hashes:
+                excluded.update(hashes[hashes.index(ref):])
+    values = [c for c in history(index, include) if c["hash"] not in excluded]
+
+    url = f"{settings.api_url}/repositories/{workspace}/{name}/commits"
+    if branch is not None:
+        return jsonify(paginate(values, f"{url}/{branch}"))
+    extra_params = f"&include={include}" + "".join(f"&exclude={b}" for b in request.args.getlist("exclude"))
+    return jsonify(paginate(values, url, extra_params))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Bitbucket API serving synthetic repositories")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5999)
+    parser.add_argument("--repos", type=int, default=50)
+    parser.add_argument("--workspaces", type=int, default=1)
+    parser.add_argument("--branches", type=int, default=3, help="branches per repo, including the main branch")
+    parser.add_argument("--commits", type=int, default=500, help="commits on the main branch of each repo")
+    parser.add_argument("--branch-commits", type=int, default=5, help="commits each other branch adds")
+    parser.add_argument("--authors", type=int, default=20)
+    parser.add_argument("--message-words", type=int, default=20, help="length of the commit message body")
+    parser.add_argument("--main-branch", default="master")
+    parser.add_argument("--latency-ms", type=float, default=20, help="mean latency added to every request")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth request with a 429")
+    parser.add_argument("--retry-after-s", type=int, default=1)
+    parser.add_argument("--rate-limit", type=int, default=1000000, help="reported in X-RateLimit-Limit")
+    parser.parse_args(namespace=settings)
+    settings.api_url = f"http://{settings.host}:{settings.port}/2.0"
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    print(f"Serving {settings.repos} repos with {settings.branches} branches and {settings.commits} commits each "
+          f"on {settings.api_url}", flush=True)
+    app.run(host=settings.host, port=settings.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Micro-benchmark for decoding Bitbucket pages: the old str based parse against parsing the
+raw bytes once with each JSON backend, and full pages against pages trimmed by the fields=
+selector of ApiFields.
+
+Usage: python benchmarks/json_decode.py [pagelen] [rounds]
+"""
+import json
+import os
+import sys
+import timeit
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.ApiFields import ApiFields  # noqa: E402
+from lib.JsonDecoder import JsonDecoder  # noqa: E402
+from fake_bitbucket import field_tree, select_fields  # noqa: E402
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def commit_values(i: int) -> dict:
+    # Shaped like a commit of the Bitbucket commits endpoint, including the fields the crawler ignores
+    commit_hash = f"{i:040x}"
+    message = f"Change {i}: " + "Refactor the module and update the callers accordingly. " * 12
+    user = {
+        "display_name": f"Developer {i % 7}",
+        "links": {"avatar": {"href": f"https://avatar.example.com/{i % 7}.png"}},
+        "type": "user",
+        "uuid": f"{{{i % 7:08x}-0000-0000-0000-000000000000}}",
+        "account_id": f"{i % 7:024x}",
+        "nickname": f"dev{i % 7}",
+    }
+    return {
+        "type": "commit",
+        "hash": commit_hash,
+        "date": "2023-01-01T12:00:00+00:00",
+        "author": {"type": "author", "raw": f"Developer {i % 7} <Dev{i % 7}@example.com>", "user": user},
+        "message": message,
+        "summary": {"type": "rendered", "raw": message, "markup": "markdown", "html": f"<p>{message}</p>"},
+        "links": {
+            "self": {"href": f"https://api.bitbucket.org/2.0/repositories/ws/repo/commit/{commit_hash}"},
+            "comments": {"href": f"https://api.bitbucket.org/2.0/repositories/ws/repo/commit/{commit_hash}/comments"},
+            "patch": {"href": f"https://api.bitbucket.org/2.0/repositories/ws/repo/patch/{commit_hash}"},
+            "html": {"href": f"https://bitbucket.org/ws/repo/commits/{commit_hash}"},
+            "diff": {"href": f"https://api.bitbucket.org/2.0/repositories/ws/repo/diff/{commit_hash}"},
+            "approve": {"href": f"https://api.bitbucket.org/2.0/repositories/ws/repo/commit/{commit_hash}/approve"},
+            "statuses": {"href": f"https://api.bitbucket.org/2.0/repositories/ws/repo/commit/{commit_hash}/statuses"},
+        },
+        "parents": [{"hash": f"{i + 1:040x}", "type": "commit"}],
+        "repository": {
+            "type": "repository",
+            "full_name": "ws/repo",
+            "name": "repo",
+            "links": {"html": {"href": "https://bitbucket.org/ws/repo"}},
+            "uuid": "{00000000-0000-0000-0000-000000000000}",
+        },
+    }
+
+
+def commit_page(pagelen: int, fields: str = None) -> Response:
+    data = {
+        "pagelen": pagelen,
+        "values": [commit_values(i) for i in range(pagelen)],
+        "next": "https://api.bitbucket.org/2.0/repositories/ws/repo/commits/master?page=2",
+    }
+    if fields is not None:
+        data = select_fields(data, field_tree(fields))
+
+    response = Response()
+    response.status_code = 200
+    response.headers = CaseInsensitiveDict({"Content-Type": "application/json; charset=utf-8"})
+    response._content = json.dumps(data).encode("utf-8")
+    return response
+
+
+def bench(name: str, fn, rounds: int, baseline_s: float = None) -> float:
+    elapsed_s = min(timeit.repeat(fn, number=rounds, repeat=5)) / rounds
+    speedup = "" if baseline_s is None else f"  x{baseline_s / elapsed_s:.1f}"
+    print(f"{name:<34} {elapsed_s * 1e6:10.1f} us/page{speedup}")
+    return elapsed_s
+
+
+def main():
+    pagelen = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    response = commit_page(pagelen)
+    selected = commit_page(pagelen, ApiFields.page_params(ApiFields.COMMIT)["fields"])
+    print(f"Commit page with {pagelen} values, {len(response.content) / 1024:.0f} KiB, "
+          f"{len(selected.content) / 1024:.0f} KiB with fields=")
+
+    baseline_s = bench("json.loads(text)", lambda: json.loads(response.text), rounds)
+    bench("json.loads(text) twice (branches)", lambda: (json.loads(response.text), json.loads(response.text)),
+          rounds, baseline_s)
+    bench("json.loads(bytes)", lambda: json.loads(response.content), rounds, baseline_s)
+    if orjson is not None:
+        bench("orjson.loads(bytes)", lambda: orjson.loads(response.content), rounds, baseline_s)
+    else:
+        print("orjson is not installed, skipping")
+    bench(f"JsonDecoder.loads ({JsonDecoder.backend})", lambda: JsonDecoder.loads(response.content), rounds,
+          baseline_s)
+    bench("json.loads(bytes) with fields=", lambda: json.loads(selected.content), rounds, baseline_s)
+    bench("JsonDecoder.loads with fields=", lambda: JsonDecoder.loads(selected.content), rounds, baseline_s)
+
+
+if __name__ == "__main__":
+    main()
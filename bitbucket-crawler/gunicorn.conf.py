@@ -0,0 +1,37 @@
+import os
+
+environment_variables = os.environ.copy()
+
+# Usage: gunicorn -c gunicorn.conf.py api:app
+# Send SIGHUP to the master process to reload the code and replace workers gracefully
+
+bind = environment_variables.get('API_BIND', '0.0.0.0:5000')
+workers = int(environment_variables.get('API_WORKERS', str(min(2 * (os.cpu_count() or 1) + 1, 8))))
+threads = int(environment_variables.get('API_THREADS', '4'))
+worker_class = 'gthread'
+
+timeout = int(environment_variables.get('API_WORKER_TIMEOUT_S', '30'))
+graceful_timeout = int(environment_variables.get('API_GRACEFUL_TIMEOUT_S', '30'))
+keepalive = int(environment_variables.get('API_KEEPALIVE_S', '5'))
+
+# Recycle workers now and then so a slow leak cannot take the api down, jittered so they do not all restart at once
+max_requests = int(environment_variables.get('API_MAX_REQUESTS', '10000'))
+max_requests_jitter = int(max_requests / 10)
+
+preload_app = True if environment_variables.get('API_PRELOAD_APP', 'false').lower() == 'true' else False
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # SQLite connections must not cross a fork: every worker opens its own read-only connections
+    import api
+    api.pool.reset()
+    api.result_cache.clear()
+    server.log.info(f"Worker {worker.pid} serving {api.DATABASE_FILE} with up to {api.pool.size} connections")
+
+
+def worker_exit(server, worker):
+    import api
+    api.pool.close()
@@ -0,0 +1,29 @@
+from typing import Dict, List, Optional
+
+
+class ApiFields:
+    """
+    The attributes each source maps into its DTO, requested through Bitbucket's fields=
+    selector so responses leave out everything else (parents, rendered markup, nested
+    owner and repository objects, ...). Paths are relative to a single value of a page.
+    """
+
+    REPO: List[str] = ["name", "workspace.slug", "mainbranch.name", "links.html.href", "updated_on"]
+    BRANCH: List[str] = ["name", "links.html.href", "target.hash"]
+    COMMIT: List[str] = [
+        "hash", "message", "summary.raw", "date", "author.raw", "links.html.href", "repository.links.html.href"
+    ]
+    PAGE: List[str] = ["next", "page", "pagelen", "size"]
+
+    enabled: bool = True
+
+    @classmethod
+    def configure(cls, enabled: Optional[bool] = None) -> None:
+        if enabled is not None:
+            cls.enabled = enabled
+
+    @classmethod
+    def page_params(cls, value_fields: List[str]) -> Dict[str, str]:
+        if not cls.enabled:
+            return {}
+        return {"fields": ",".join(cls.PAGE + [f"values.{f}" for f in value_fields])}
@@ -0,0 +1,154 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+from .HttpCache import HttpCache
+from .Metrics import Metrics
+from .RequestScheduler import RETRYABLE_STATUS_CODES, RequestScheduler
+
+
+class BitbucketClient:
+    """
+    Shared HTTP layer for the Bitbucket sources. One pooled keep-alive session is kept
+    per set of credentials so consecutive page requests reuse open connections, and
+    every request is paced and retried by the shared RequestScheduler. When an HttpCache
+    is configured, requests are made conditional and a 304 is answered from disk.
+    """
+
+    api_url: str = "https://api.bitbucket.org/2.0"
+    pool_size: int = 10
+    timeout_s: float = 60
+    scheduler: RequestScheduler = RequestScheduler()
+    cache: Optional[HttpCache] = None
+
+    _sessions: Dict[Tuple[str, str], requests.Session] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, pool_size: Optional[int] = None, timeout_s: Optional[float] = None,
+                  api_url: Optional[str] = None, scheduler: Optional[RequestScheduler] = None,
+                  cache: Optional[HttpCache] = None) -> None:
+        with cls._lock:
+            if cache is not None:
+                cls.cache = cache
+            if scheduler is not None:
+                cls.scheduler = scheduler
+            if api_url is not None:
+                cls.api_url = api_url.rstrip("/")
+            if pool_size is not None:
+                cls.pool_size = max(1, pool_size)
+            if timeout_s is not None:
+                cls.timeout_s = timeout_s
+            cls._close_sessions()
+
+    @classmethod
+    def session(cls, bitbucket_username: str, bitbucket_app_password: str) -> requests.Session:
+        key = (bitbucket_username, bitbucket_app_password)
+        with cls._lock:
+            session = cls._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.auth = HTTPBasicAuth(bitbucket_username, bitbucket_app_password)
+                session.headers.update({
+                    "Accept": "application/json",
+                    "Accept-Encoding": "gzip, deflate",
+                })
+                adapter = HTTPAdapter(pool_connections=cls.pool_size, pool_maxsize=cls.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                cls._sessions[key] = session
+            return session
+
+    @classmethod
+    def get(cls, bitbucket_username: str, bitbucket_app_password: str, url: str,
+            params: Optional[dict] = None) -> Response:
+        session = cls.session(bitbucket_username, bitbucket_app_password)
+        scheduler = cls.scheduler
+        cache = cls.cache
+
+        headers = {}
+        cache_key = None
+        cached = None
+        if cache is not None:
+            request_url = requests.Request("GET", url, params=params).prepare().url
+            cache_key = HttpCache.key(request_url, scope=bitbucket_username)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                headers = cached.conditional_headers()
+
+        endpoint = cls.endpoint(url)
+        attempt = 0
+        while True:
+            paused_s, paced_s = scheduler.acquire()
+            if paused_s > 0:
+                Metrics.inc("rate_limit_wait_seconds_total", paused_s, reason="rate_limited")
+            if paced_s > 0:
+                Metrics.inc("rate_limit_wait_seconds_total", paced_s, reason="pacing")
+            started = time.perf_counter()
+            try:
+                response = session.get(url, params=params, headers=headers, timeout=cls.timeout_s)
+            except (requests.ConnectionError, requests.Timeout):
+                Metrics.inc("http_connection_errors_total", endpoint=endpoint)
+                if attempt >= scheduler.max_retries:
+                    raise
+                delay_s = scheduler.retry_delay(None, attempt)
+                print(f"Connection failed, waiting {delay_s:.1f}s before retrying")
+                Metrics.inc("rate_limit_wait_seconds_total", delay_s, reason="connection_error")
+                time.sleep(delay_s)
+                attempt += 1
+                continue
+
+            Metrics.inc("http_request_seconds_total", time.perf_counter() - started, endpoint=endpoint)
+            Metrics.inc("http_requests_total", endpoint=endpoint, status=response.status_code)
+            Metrics.inc("http_response_bytes_total", len(response.content), endpoint=endpoint)
+            scheduler.observe(response)
+            if not scheduler.should_retry(response, attempt):
+                if response.status_code in RETRYABLE_STATUS_CODES:
+                    # Out of retries: fail with the HTTP error rather than hand the error body to the sources
+                    print(f"Received {response.status_code} after {attempt} retries, giving up")
+                    response.raise_for_status()
+                if cache is not None:
+                    if response.status_code == 304 and cached is not None:
+                        Metrics.inc("http_cache_hits_total", endpoint=endpoint)
+                        return cached.to_response(response)
+                    if response.status_code == 200:
+                        cache.put(cache_key, response)
+                return response
+
+            delay_s = scheduler.retry_delay(response, attempt)
+            print(f"Received {response.status_code}, waiting {delay_s:.1f}s before retrying")
+            Metrics.inc("http_retries_total", status=response.status_code)
+            if response.status_code == 429:
+                # The wait itself is counted by acquire, in every thread that shares the scheduler
+                scheduler.pause(delay_s)
+            else:
+                Metrics.inc("rate_limit_wait_seconds_total", delay_s, reason="server_error")
+                time.sleep(delay_s)
+            attempt += 1
+
+    @classmethod
+    def endpoint(cls, url: str) -> str:
+        # repositories/{workspace}/{repo}/{endpoint}/... -> endpoint, without ids that would explode the label set
+        path = urlsplit(url).path
+        api_path = urlsplit(cls.api_url).path
+        parts = [p for p in path[len(api_path):].split("/") if p] if path.startswith(api_path) else []
+        if len(parts) >= 4:
+            return parts[3]
+        return parts[0] if len(parts) > 0 else "other"
+
+    @classmethod
+    def close(cls) -> None:
+        with cls._lock:
+            cls._close_sessions()
+
+    @classmethod
+    def _close_sessions(cls) -> None:
+        for session in cls._sessions.values():
+            session.close()
+        cls._sessions = {}
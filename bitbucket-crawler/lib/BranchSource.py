@@ -1,12 +1,12 @@
-import json
-import time
 from datetime import datetime
-from typing import Tuple, List
+from typing import Iterator, Optional, Tuple, List
 
-import requests
+from .ApiFields import ApiFields
+from .BitbucketClient import BitbucketClient
+from .JsonDecoder import JsonDecoder
+from .Page import Page
 from .storage.dto import *
 from requests import Response
-from requests.auth import HTTPBasicAuth
 
 
 class BranchSource:
@@ -21,15 +21,30 @@ class BranchSource:
             branch_page_limit: int = -1
     ) -> List[Tuple[Branch, RepoBranchLink]]:
         results: List[Tuple[Branch, RepoBranchLink]] = []
+        for page in cls.iter_branches(bitbucket_username, bitbucket_app_password, repo_workspace, repo_name,
+                                      page_length, branch_page_limit):
+            results.extend(page.values)
+        return results
 
-        auth = HTTPBasicAuth(bitbucket_username, bitbucket_app_password)
+    @classmethod
+    def iter_branches(
+            cls,
+            bitbucket_username: str,
+            bitbucket_app_password: str,
+            repo_workspace: str,
+            repo_name: str,
+            page_length: int = 100,
+            branch_page_limit: int = -1,
+            start_url: Optional[str] = None
+    ) -> Iterator[Page[Tuple[Branch, RepoBranchLink]]]:
+        branch_count = 0
 
-        starting_branch_page_url = f"https://api.bitbucket.org/2.0/repositories/{repo_workspace}/{repo_name}/refs"
-        next_page_url = starting_branch_page_url
+        starting_branch_page_url = f"{BitbucketClient.api_url}/repositories/{repo_workspace}/{repo_name}/refs"
+        next_page_url = starting_branch_page_url if start_url is None else start_url
         branches_page_number = 1
 
         has_more_pages = True
-        branch_params = {"pagelen": f"{page_length}"}
+        branch_params = {"pagelen": f"{page_length}", **ApiFields.page_params(ApiFields.BRANCH)}
 
         while has_more_pages:
             if branch_page_limit == 1 and branches_page_number == 1:
@@ -39,29 +54,20 @@ class BranchSource:
                 break
 
             print(f"Fetching page {branches_page_number}: Branches of {repo_name} ")
-            response: Response = requests.get(
-                next_page_url, auth=auth, params=branch_params
+            response: Response = BitbucketClient.get(
+                bitbucket_username, bitbucket_app_password, next_page_url, params=branch_params
             )
 
-            backoff_s = 10
-            while response.status_code == 429:
-                print(f"Waiting {backoff_s}s before retrying")
-                time.sleep(backoff_s)
-                response = requests.get(next_page_url, auth=auth, params=branch_params)
-
-                if response.status_code == 429:
-                    backoff_s *= 2
-
-            page_data = json.loads(response.text)
-            if page_data.get("next") is not None:
-                next_page_url = page_data.get("next")
+            page_data = JsonDecoder.loads(response.content)
+            page: Page[Tuple[Branch, RepoBranchLink]] = Page(branches_page_number, next=page_data.get("next"))
+            if page.next is not None:
+                next_page_url = page.next
                 has_more_pages = True
                 branches_page_number += 1
             else:
                 has_more_pages = False
 
-            branches = json.loads(response.text)
-            values = branches.get("values")
+            values = page_data.get("values")
 
             for bi, b in enumerate(values):
                 branch = Branch(
@@ -69,13 +75,16 @@ class BranchSource:
                     repo=repo_name,
                     url=b.get("links", {}).get("html", {}).get("href"),
                     update_ts=datetime.now().isoformat(),
+                    head_hash=b.get("target", {}).get("hash"),
                 )
 
                 link = RepoBranchLink(
                     repo_name=repo_name,
                     branch_name=branch.name,
                 )
-                results.append((branch, link))
+                page.values.append((branch, link))
 
-        print(f"Fetched {len(results)} branches for {repo_name}")
-        return results
+            branch_count += len(page.values)
+            yield page
+
+        print(f"Fetched {branch_count} branches for {repo_name}")
@@ -1,26 +1,51 @@
-import json
-import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from json import JSONDecodeError
-from typing import List, Tuple
+from typing import Deque, Iterator, List, Optional, Set, Tuple
 
-import requests as requests
+from .ApiFields import ApiFields
+from .BitbucketClient import BitbucketClient
+from .JsonDecoder import JsonDecoder
+from .Page import Page
 from .storage.dto import *
 from requests import Response
-from requests.auth import HTTPBasicAuth
 
 
 class CommitSource:
     @classmethod
     def get_commits(cls, bitbucket_username: str, bitbucket_app_password: str, repo: Repo, branch: Branch,
-                    page_length: int = 100, commit_page_limit: int = 100) -> List[
-        Tuple[Commit, BranchCommitLink]]:
-        auth = HTTPBasicAuth(bitbucket_username, bitbucket_app_password)
+                    page_length: int = 100, commit_page_limit: int = 100,
+                    known_commit_hash: Optional[str] = None) -> List[Tuple[Commit, BranchCommitLink]]:
         results: List[Tuple[Commit, BranchCommitLink]] = []
+        for page in cls.iter_commits(bitbucket_username, bitbucket_app_password, repo, branch, page_length,
+                                     commit_page_limit, known_commit_hash):
+            results.extend(page.values)
+        return results
 
-        commit_url = f"https://api.bitbucket.org/2.0/repositories/{repo.workspace}/{repo.name}/commits/{branch.name}"
+    @classmethod
+    def iter_commits(cls, bitbucket_username: str, bitbucket_app_password: str, repo: Repo, branch: Branch,
+                     page_length: int = 100, commit_page_limit: int = 100,
+                     known_commit_hash: Optional[str] = None,
+                     start_page: int = 1, exclude: Optional[List[str]] = None,
+                     seen_hashes: Optional[Set[str]] = None,
+                     page_fanout: int = 1) -> Iterator[Page[Tuple[Commit, BranchCommitLink]]]:
+        commit_count = 0
+
+        # The last known commit is excluded along with its ancestors, which also drops older commits merged in
+        # since, where stopping at the known hash in the date ordered listing would miss them
+        excluding_known_commit = known_commit_hash is not None
+        known_commit_dropped = False
+        commit_url, commit_params = cls._listing(
+            repo, branch, page_length, (exclude or []) + ([known_commit_hash] if excluding_known_commit else [])
+        )
+
+        # Page numbers are known up front once the total is, so the rest can be requested together. Not when
+        # the crawl may stop early at an already fetched commit, that would request pages for nothing.
+        # Decided before the first page, which the writer adds to seen_hashes while this generator is suspended.
+        fan_out = page_fanout > 1 and not seen_hashes
 
         commit_has_next = True
-        commit_page_number = 1
+        commit_page_number = start_page
 
         while commit_has_next:
 
@@ -30,56 +55,140 @@ class CommitSource:
                 print(f"Hit commit page limit: {commit_page_limit}")
                 break
 
-            print(f"Looking for commits on branch {branch.name} page #{commit_page_number}")
-            commit_current_page_params = {
-                "pagelen": f"{page_length}",
-                "page": f"{commit_page_number}",
-                "sort": "-date"
-            }
+            response = cls._request_page(bitbucket_username, bitbucket_app_password, branch, commit_url,
+                                         commit_params, commit_page_number)
+            if excluding_known_commit and response.status_code != 200:
+                # The known commit is gone, e.g. rewritten away by a force push and garbage collected: list the
+                # whole branch again rather than fail on every crawl
+                print(f"Received {response.status_code} excluding last known commit {known_commit_hash[:7]} "
+                      f"on branch {branch.name}, crawling the branch without it")
+                excluding_known_commit = False
+                known_commit_dropped = True
+                known_commit_hash = None
+                commit_url, commit_params = cls._listing(repo, branch, page_length, exclude or [])
+                commit_page_number = 1
+                continue
+            excluding_known_commit = False
 
-            response: Response = requests.get(commit_url, auth=auth, params=commit_current_page_params)
+            try:
+                page = cls._parse_page(repo, branch, commit_page_number, response, known_commit_hash, seen_hashes)
+            except JSONDecodeError as e:
+                print("Invalid JSON for", response)
+                break
+            page.known_commit_dropped = known_commit_dropped
+
+            commit_has_next = page.next is not None
+            commit_page_number += 1
+            commit_count += len(page.values)
+            yield page
+
+            if fan_out and commit_has_next and page.size is not None:
+                last_page = -(-page.size // page_length)
+                if commit_page_limit > 0 and last_page > max(1, commit_page_limit - 1):
+                    last_page = max(1, commit_page_limit - 1)
+                    print(f"Hit commit page limit: {commit_page_limit}")
+                for page in cls._iter_pages_parallel(bitbucket_username, bitbucket_app_password, repo, branch,
+                                                     commit_url, commit_params, commit_page_number, last_page,
+                                                     page_fanout):
+                    commit_count += len(page.values)
+                    yield page
+                break
 
-            backoff_s = 10
-            while response.status_code == 429:
-                print(f"Waiting {backoff_s}s before retrying")
-                time.sleep(backoff_s)
-                response = requests.get(commit_url, auth=auth, params=commit_current_page_params)
+        print(f"Fetched {commit_count} commits for {repo.name} branch {branch.name}")
 
-                if response.status_code == 429:
-                    backoff_s *= 2
+    @classmethod
+    def _listing(cls, repo: Repo, branch: Branch, page_length: int, exclude: List[str]) -> Tuple[str, dict]:
+        if exclude:
+            # Only commits reachable from the branch but not from any excluded ref, e.g. the main branch
+            commit_url = f"{BitbucketClient.api_url}/repositories/{repo.workspace}/{repo.name}/commits"
+            branch_params = {"include": branch.name, "exclude": exclude}
+        else:
+            commit_url = f"{BitbucketClient.api_url}/repositories/{repo.workspace}/{repo.name}/commits/{branch.name}"
+            branch_params = {}
+        return commit_url, {
+            "pagelen": f"{page_length}",
+            "sort": "-date",
+            **branch_params,
+            **ApiFields.page_params(ApiFields.COMMIT)
+        }
 
-            try:
-                commit_page_data = json.loads(response.text)
-                # print( f"{repo.workspace}/{repo.name} parsing {len(commit_page_data['values'])} commits on branch {branch.name}")
-
-                if commit_page_data.get('next') is not None:
-                    commit_has_next = True
-                    commit_page_number += 1
-                else:
-                    commit_has_next = False
-
-                for values in commit_page_data.get('values'):
-                    repo_d: dict = values.get('repository')
-                    author: str = values.get('author', {}).get('raw')
-                    email: str = author[author.find("<") + 1:author.find(">")].lower()
-                    commit = Commit(
-                        hash=values.get('hash'),
-                        message=values.get('message'),
-                        summary=values.get('summary', {}).get('raw'),
-                        date=values.get('date'),
-                        author=author.replace(email, '').replace('<>', '').strip(),
-                        email=email,
-                        diff_link=values.get('links', {}).get('html', {}).get('href'),
-                        repo_url=repo_d.get('links', {}).get('html', {}).get('href', {})
-                    )
-
-                    link = BranchCommitLink(branch.name, commit.hash)
-
-                    results.append((commit, link))
+    @classmethod
+    def _iter_pages_parallel(cls, bitbucket_username: str, bitbucket_app_password: str, repo: Repo, branch: Branch,
+                             commit_url: str, commit_params: dict, first_page: int, last_page: int,
+                             page_fanout: int) -> Iterator[Page[Tuple[Commit, BranchCommitLink]]]:
+        # A window of page_fanout requests is kept in flight and pages are handed out in page order
+        executor = ThreadPoolExecutor(max_workers=page_fanout, thread_name_prefix="commit-pages")
+        in_flight: Deque[Tuple[int, Future]] = deque()
+        next_page_number = first_page
+        try:
+            while next_page_number <= last_page or len(in_flight) > 0:
+                while next_page_number <= last_page and len(in_flight) < page_fanout:
+                    in_flight.append((next_page_number, executor.submit(
+                        cls._request_page, bitbucket_username, bitbucket_app_password, branch, commit_url,
+                        commit_params, next_page_number
+                    )))
+                    next_page_number += 1
+
+                page_number, future = in_flight.popleft()
+                response = future.result()
+                try:
+                    page = cls._parse_page(repo, branch, page_number, response, None, None)
+                except JSONDecodeError as e:
+                    print("Invalid JSON for", response)
+                    return
+                yield page
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
 
-            except JSONDecodeError as e:
-                print("Invalid JSON for", response)
-                commit_has_next = False
+    @classmethod
+    def _request_page(cls, bitbucket_username: str, bitbucket_app_password: str, branch: Branch, commit_url: str,
+                      commit_params: dict, commit_page_number: int) -> Response:
+        print(f"Looking for commits on branch {branch.name} page #{commit_page_number}")
+        return BitbucketClient.get(
+            bitbucket_username, bitbucket_app_password, commit_url,
+            params={**commit_params, "page": f"{commit_page_number}"}
+        )
 
-        print(f"Fetched {len(results)} commits for {repo.name} branch {branch.name}")
-        return results
+    @classmethod
+    def _parse_page(cls, repo: Repo, branch: Branch, commit_page_number: int, response: Response,
+                    known_commit_hash: Optional[str],
+                    seen_hashes: Optional[Set[str]]) -> Page[Tuple[Commit, BranchCommitLink]]:
+        commit_page_data = JsonDecoder.loads(response.content)
+        # print( f"{repo.workspace}/{repo.name} parsing {len(commit_page_data['values'])} commits on branch {branch.name}")
+
+        page: Page[Tuple[Commit, BranchCommitLink]] = Page(
+            commit_page_number, next=commit_page_data.get('next'), size=commit_page_data.get('size')
+        )
+
+        for values in commit_page_data.get('values'):
+            if known_commit_hash is not None and values.get('hash') == known_commit_hash:
+                # Only reached when the exclude was not applied
+                print(f"Reached last known commit {known_commit_hash[:7]} on branch {branch.name}")
+                page.next = None
+                break
+
+            repo_d: dict = values.get('repository')
+            author: str = values.get('author', {}).get('raw')
+            email: str = author[author.find("<") + 1:author.find(">")].lower()
+            commit = Commit(
+                hash=values.get('hash'),
+                message=values.get('message'),
+                summary=values.get('summary', {}).get('raw'),
+                date=values.get('date'),
+                author=author.replace(email, '').replace('<>', '').strip(),
+                email=email,
+                diff_link=values.get('links', {}).get('html', {}).get('href'),
+                repo_url=repo_d.get('links', {}).get('html', {}).get('href', {})
+            )
+
+            link = BranchCommitLink(branch.name, commit.hash)
+
+            page.values.append((commit, link))
+
+        if seen_hashes is not None and len(page.values) > 0 \
+                and all(commit.hash in seen_hashes for commit, _ in page.values):
+            # History shared with a branch crawled before: the older pages have been stored already
+            print(f"Reached commits already fetched from another branch of {repo.name} on branch {branch.name}")
+            page.next = None
+
+        return page
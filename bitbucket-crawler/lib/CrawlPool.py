@@ -0,0 +1,85 @@
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional, Set, Tuple
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class CrawlPool:
+    """
+    Fans fetch jobs out over a bounded pool of worker threads while keeping every
+    result on the calling thread, so a single writer owns the database connection.
+    Jobs return iterables and each item is handed to the writer as soon as it arrives.
+    """
+
+    def __init__(self, concurrency: int = 1, queue_size: int = 0):
+        self.concurrency = max(1, concurrency)
+        self.queue_size = queue_size
+
+    def run(
+            self,
+            jobs: Iterable[Tuple[Any, Callable[[], Iterable[Any]]]],
+            consume: Callable[[Any, Any], None],
+            on_done: Optional[Callable[[Any], None]] = None
+    ) -> None:
+        results: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        stopped = threading.Event()
+
+        def put(result: Tuple[int, Any]) -> None:
+            # A bounded queue applies back pressure to the workers, but must not block them after the writer stopped
+            while not stopped.is_set():
+                try:
+                    results.put(result, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+
+        def work(job_id: int, job: Callable[[], Iterable[Any]]) -> None:
+            try:
+                for item in job():
+                    if stopped.is_set():
+                        break
+                    put((job_id, item))
+            except Exception as e:
+                put((job_id, _Failure(e)))
+            finally:
+                put((job_id, _DONE))
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="crawl")
+        try:
+            keys: Dict[int, Any] = {}
+            for job_id, (key, job) in enumerate(jobs):
+                keys[job_id] = key
+                executor.submit(work, job_id, job)
+
+            failed: Set[int] = set()
+            while len(keys) > 0:
+                job_id, item = results.get()
+                key = keys[job_id]
+                if item is _DONE:
+                    del keys[job_id]
+                    if on_done is not None and job_id not in failed:
+                        on_done(key)
+                elif isinstance(item, _Failure):
+                    failed.add(job_id)
+                    print(f"An error occurred in crawl job {key}")
+                    traceback.print_exception(type(item.error), item.error, item.error.__traceback__)
+                    print("Continuing")
+                elif job_id not in failed:
+                    try:
+                        consume(key, item)
+                    except Exception:
+                        failed.add(job_id)
+                        print(f"An error occurred storing results of crawl job {key}")
+                        traceback.print_exc()
+                        print("Continuing")
+        finally:
+            stopped.set()
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from attrs import define
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+CACHED_HEADERS = ["Content-Type", "ETag", "Last-Modified"]
+
+
+@define
+class CachedResponse:
+    etag: Optional[str]
+    last_modified: Optional[str]
+    headers: Dict[str, str]
+    body: bytes
+
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_response(self, not_modified: Response) -> Response:
+        response = Response()
+        response.status_code = 200
+        response._content = self.body
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.headers["X-Cache"] = "HIT"
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response.encoding = "utf-8"
+        return response
+
+
+class HttpCache:
+    """
+    On-disk store of validated responses keyed by request URL. Each entry is a body file
+    plus a small metadata file; the least recently used entries are evicted once the
+    cache grows beyond max_size_bytes.
+    """
+
+    def __init__(self, directory: str, max_size_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def key(url: str, scope: str = "") -> str:
+        return hashlib.sha256(f"{scope}\n{url}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            try:
+                with open(self._meta_path(key), "r") as meta_file:
+                    meta = json.load(meta_file)
+                with open(self._body_path(key), "rb") as body_file:
+                    body = body_file.read()
+            except (OSError, ValueError):
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            os.utime(self._meta_path(key))
+            return CachedResponse(
+                etag=meta.get("etag"),
+                last_modified=meta.get("last_modified"),
+                headers=meta.get("headers", {}),
+                body=body
+            )
+
+    def put(self, key: str, response: Response) -> None:
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+
+        body = response.content
+        if len(body) > self.max_size_bytes:
+            return
+
+        meta = {
+            "url": response.url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "headers": {h: response.headers[h] for h in CACHED_HEADERS if h in response.headers},
+        }
+        with self._lock:
+            self._remove(key)
+            with open(self._body_path(key), "wb") as body_file:
+                body_file.write(body)
+            with open(self._meta_path(key), "w") as meta_file:
+                json.dump(meta, meta_file)
+
+            self._entries[key] = len(body)
+            self._size_bytes += len(body)
+            while self._size_bytes > self.max_size_bytes and len(self._entries) > 0:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    def _load_index(self) -> None:
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json"):
+                continue
+            key = file_name[:-len(".json")]
+            try:
+                last_used = os.path.getmtime(self._meta_path(key))
+                size = os.path.getsize(self._body_path(key))
+            except OSError:
+                continue
+            entries.append((last_used, key, size))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size_bytes += size
+
+    def _remove(self, key: str) -> None:
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._size_bytes -= size
+        for path in (self._meta_path(key), self._body_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _body_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.body")
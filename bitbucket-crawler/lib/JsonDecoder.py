@@ -0,0 +1,36 @@
+import json
+from typing import Any, Callable, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonDecoder:
+    """
+    Decodes response bodies straight from bytes with a swappable backend. orjson is used
+    when it is installed; both backends raise json.JSONDecodeError on invalid input.
+    """
+
+    BACKENDS = ("auto", "orjson", "json")
+
+    backend: str = "json" if orjson is None else "orjson"
+    _loads: Callable[[Union[bytes, str]], Any] = json.loads if orjson is None else orjson.loads
+
+    @classmethod
+    def configure(cls, backend: str = "auto") -> str:
+        if backend not in cls.BACKENDS:
+            raise ValueError(f"Unknown JSON backend {backend}. Possible backends: {','.join(cls.BACKENDS)}")
+        if backend == "orjson" and orjson is None:
+            raise ValueError("JSON backend orjson is not installed")
+
+        if backend == "json" or (backend == "auto" and orjson is None):
+            cls.backend, cls._loads = "json", json.loads
+        else:
+            cls.backend, cls._loads = "orjson", orjson.loads
+        return cls.backend
+
+    @classmethod
+    def loads(cls, data: Union[bytes, str]) -> Any:
+        return cls._loads(data)
@@ -0,0 +1,164 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, Tuple
+
+PREFIX = "bitbucket_crawler_"
+
+# name: (type, help)
+DESCRIPTIONS: Dict[str, Tuple[str, str]] = {
+    "http_requests_total": ("counter", "Bitbucket API responses by endpoint and status code"),
+    "http_response_bytes_total": ("counter", "Decoded bytes of Bitbucket API responses by endpoint"),
+    "http_request_seconds_total": ("counter", "Time spent waiting for Bitbucket API responses by endpoint"),
+    "http_cache_hits_total": ("counter", "Responses answered from the HTTP cache after a 304"),
+    "http_connection_errors_total": ("counter", "Requests that failed to connect or timed out"),
+    "http_retries_total": ("counter", "Requests retried by status code"),
+    "rate_limit_wait_seconds_total": ("counter", "Time spent waiting before requests by reason, summed over threads"),
+    "rows_submitted_total": ("counter", "Rows handed to the database writer by table"),
+    "rows_inserted_total": ("counter", "Rows actually inserted or replaced by table"),
+    "write_flush_seconds_total": ("counter", "Time spent committing batches to the database"),
+    "phase_duration_seconds": ("gauge", "Wall time of each crawl phase"),
+}
+
+
+class Metrics:
+    """
+    Process wide counters and phase timers for the crawler, exported in the Prometheus
+    text format (file or HTTP endpoint) and as a JSON summary at the end of a crawl.
+    """
+
+    _values: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+    _started = time.time()
+    _lock = threading.Lock()
+
+    @classmethod
+    def inc(cls, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with cls._lock:
+            cls._values[key] = cls._values.get(key, 0) + value
+
+    @classmethod
+    def set(cls, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with cls._lock:
+            cls._values[key] = value
+
+    @classmethod
+    @contextmanager
+    def phase(cls, phase: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.inc("phase_duration_seconds", time.perf_counter() - started, phase=phase)
+
+    @classmethod
+    def timed(cls, phase: str):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with cls.phase(phase):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls._lock:
+            cls._values = {}
+            cls._started = time.time()
+
+    @classmethod
+    def prometheus_text(cls) -> str:
+        with cls._lock:
+            values = sorted(cls._values.items())
+
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            if name not in described:
+                metric_type, help_text = DESCRIPTIONS.get(name, ("untyped", name))
+                lines.append(f"# HELP {PREFIX}{name} {help_text}")
+                lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+                described.add(name)
+            label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+            value_text = str(int(value)) if float(value).is_integer() else repr(float(value))
+            lines.append(f"{PREFIX}{name}{{{label_text}}} {value_text}" if label_text else f"{PREFIX}{name} {value_text}")
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def summary(cls) -> dict:
+        with cls._lock:
+            values = sorted(cls._values.items())
+
+        metrics: Dict[str, Dict[str, float]] = {}
+        for (name, labels), value in values:
+            label_text = ",".join(f"{k}={v}" for k, v in labels)
+            metrics.setdefault(name, {})[label_text] = round(value, 3)
+        return {
+            "started": datetime.fromtimestamp(cls._started).isoformat(),
+            "elapsed_s": round(time.time() - cls._started, 3),
+            "metrics": metrics,
+        }
+
+    @classmethod
+    def write_prometheus(cls, path: str) -> None:
+        # Written to a temporary file first so a textfile collector never reads half a file
+        _write_atomic(path, cls.prometheus_text())
+
+    @classmethod
+    def write_summary(cls, path: str) -> None:
+        _write_atomic(path, json.dumps(cls.summary(), indent=2))
+
+    @classmethod
+    def serve(cls, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = cls.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+    @classmethod
+    def print_summary(cls) -> None:
+        summary = cls.summary()
+        metrics = summary["metrics"]
+        print(f"Crawl took {summary['elapsed_s']:.1f}s")
+        for labels, seconds in metrics.get("phase_duration_seconds", {}).items():
+            print(f"  {labels.replace('phase=', '')}: {seconds:.1f}s")
+        for labels, count in metrics.get("http_requests_total", {}).items():
+            print(f"  requests {labels}: {count:g}")
+        for labels, seconds in metrics.get("rate_limit_wait_seconds_total", {}).items():
+            print(f"  waited {labels}: {seconds:.1f}s")
+        for labels, count in metrics.get("rows_inserted_total", {}).items():
+            print(f"  inserted {labels}: {count:g}")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _write_atomic(path: str, text: str) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as f:
+        f.write(text)
+    os.replace(temporary_path, path)
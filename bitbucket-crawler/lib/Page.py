@@ -0,0 +1,16 @@
+from typing import Generic, List, Optional, TypeVar
+
+from attrs import define, field
+
+T = TypeVar("T")
+
+
+@define
+class Page(Generic[T]):
+    number: int
+    values: List[T] = field(factory=list)
+    next: Optional[str] = None
+    # Total number of values across all pages, when the API reports it
+    size: Optional[int] = None
+    # Set on commit pages when the last known commit could not be excluded and the whole branch is listed
+    known_commit_dropped: bool = False
@@ -1,22 +1,31 @@
-import json
-import time
 from datetime import datetime
-from typing import List
+from typing import Iterator, List, Optional
 from urllib import parse
 
-import requests
+from dateutil.parser import isoparse
+
+from .ApiFields import ApiFields
+from .BitbucketClient import BitbucketClient
+from .JsonDecoder import JsonDecoder
+from .Page import Page
 from .storage.dto import *
 from requests import Response
-from requests.auth import HTTPBasicAuth
 
 
 class RepoSource:
     @classmethod
     def get_repos(cls, bitbucket_username: str, bitbucket_app_password: str, ignored_repos: List[str]) -> List[Repo]:
         result: List[Repo] = []
-        auth = HTTPBasicAuth(bitbucket_username, bitbucket_app_password)
+        for page in cls.iter_repos(bitbucket_username, bitbucket_app_password, ignored_repos):
+            result.extend(page.values)
+        result.sort(key=lambda x: x.name.lower(), reverse=False)
+        return result
 
-        starting_repo_page_url = 'https://api.bitbucket.org/2.0/repositories'
+    @classmethod
+    def iter_repos(cls, bitbucket_username: str, bitbucket_app_password: str, ignored_repos: List[str],
+                   start_url: Optional[str] = None, updated_since: Optional[str] = None) -> Iterator[Page[Repo]]:
+        repo_count = 0
+        starting_repo_page_url = f'{BitbucketClient.api_url}/repositories'
         next_page_url = starting_repo_page_url
         repo_page_number = 1
 
@@ -25,25 +34,26 @@ class RepoSource:
             "role": "member",
             "pagelen": "100",
             "sort": "-updated_on",
-            "after": datetime(1970, 1, 1, 0, 0, 0, 0).isoformat()
+            "after": datetime(1970, 1, 1, 0, 0, 0, 0).isoformat(),
+            **ApiFields.page_params(ApiFields.REPO)
         }
+        # Repos are listed most recently updated first, so everything after an older repo is older too
+        updated_since_dt = None if updated_since is None else isoparse(updated_since)
+        if start_url is not None:
+            next_page_url = start_url
+            repo_params['after'] = parse.parse_qs(start_url).get('after', [repo_params['after']])[0]
+
         while repo_has_more_pages:
             print(f"Fetching page {repo_page_number}: Repositories after {repo_params.get('after')} ")
 
-            response: Response = requests.get(next_page_url, auth=auth, params=repo_params)
-
-            backoff_s = 10
-            while response.status_code == 429:
-                print(f"Waiting {backoff_s}s before retrying")
-                time.sleep(backoff_s)
-                response = requests.get(next_page_url, auth=auth, params=repo_params)
+            response: Response = BitbucketClient.get(
+                bitbucket_username, bitbucket_app_password, next_page_url, params=repo_params
+            )
 
-                if response.status_code == 429:
-                    backoff_s *= 2
-
-            page_data = json.loads(response.text)
-            if page_data.get('next') is not None:
-                next_page_url = page_data.get('next')
+            page_data = JsonDecoder.loads(response.content)
+            page: Page[Repo] = Page(repo_page_number, next=page_data.get('next'))
+            if page.next is not None:
+                next_page_url = page.next
                 parsed_url = parse.parse_qs(next_page_url)
                 repo_params['after'] = parsed_url['after'][0]
                 repo_has_more_pages = True
@@ -52,6 +62,14 @@ class RepoSource:
                 repo_has_more_pages = False
 
             for vi, repo_values in enumerate(page_data.get('values')):
+                updated_on = repo_values.get('updated_on')
+                if updated_since_dt is not None and updated_on is not None \
+                        and isoparse(updated_on) < updated_since_dt:
+                    print(f"Reached repositories not updated since {updated_since}")
+                    repo_has_more_pages = False
+                    page.next = None
+                    break
+
                 workspace = repo_values.get('workspace', {}).get('slug')
                 name = repo_values.get('name', {})
                 mainbranch = repo_values.get('mainbranch',{}).get('name')
@@ -71,9 +89,12 @@ class RepoSource:
                     main_branch=mainbranch,
                     main_branch_url=mainbranch_url,
                     repo_url=repo_url,
-                    update_ts=datetime.now().isoformat()
+                    update_ts=datetime.now().isoformat(),
+                    updated_on=updated_on
                 )
-                result.append(repo)
-        result.sort(key=lambda x: x.name.lower(), reverse=False)
-        print(f"Fetched {len(result)} repositories")
-        return result
+                page.values.append(repo)
+
+            repo_count += len(page.values)
+            yield page
+
+        print(f"Fetched {repo_count} repositories")
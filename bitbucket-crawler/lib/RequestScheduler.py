@@ -0,0 +1,137 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Tuple
+
+from requests import Response
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RequestScheduler:
+    """
+    Paces requests with a token bucket sized to the hourly API quota. A rate limited
+    response pauses every caller sharing the scheduler, not just the one that hit it.
+    Processes that split one quota each get a share of it, of the configured rate and
+    of any limit the API reports.
+    """
+
+    def __init__(
+            self,
+            requests_per_hour: int = 1000,
+            max_retries: int = 8,
+            base_backoff_s: float = 10,
+            max_backoff_s: float = 300,
+            share: float = 1.0
+    ):
+        self.share = share
+        self.configured_capacity = max(1.0, requests_per_hour * share)
+        self.capacity = self.configured_capacity
+        self.rate_per_s = self.capacity / 3600
+        self.max_retries = max_retries
+        self.base_backoff_s = base_backoff_s
+        self.max_backoff_s = max_backoff_s
+
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Tuple[float, float]:
+        # Returns how long the caller waited for its turn: paused after a rate limited response, and paced
+        # by the token bucket
+        paused_s = 0.0
+        paced_s = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                paused = now < self._paused_until
+                if paused:
+                    wait_s = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return paused_s, paced_s
+                else:
+                    wait_s = (1 - self._tokens) / self.rate_per_s
+            time.sleep(wait_s)
+            if paused:
+                paused_s += wait_s
+            else:
+                paced_s += wait_s
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def observe(self, response: Response) -> None:
+        headers = response.headers
+        with self._lock:
+            # The reported limit can only lower the configured rate, never raise it
+            limit = _header_float(headers.get("X-RateLimit-Limit"))
+            if limit is not None and limit > 0:
+                capacity = max(1.0, min(self.configured_capacity, limit * self.share))
+                if capacity != self.capacity:
+                    self.capacity = capacity
+                    self.rate_per_s = capacity / 3600
+                    self._tokens = min(self._tokens, capacity)
+
+            remaining = _header_float(headers.get("X-RateLimit-Remaining"))
+            if remaining is not None:
+                self._tokens = min(self._tokens, remaining * self.share)
+
+            # Bitbucket flags responses once less than 20% of the quota is left
+            if headers.get("X-RateLimit-NearLimit", "").lower() == "true":
+                self._tokens = min(self._tokens, self.capacity * 0.2)
+
+    def should_retry(self, response: Response, attempt: int) -> bool:
+        return response.status_code in RETRYABLE_STATUS_CODES and attempt < self.max_retries
+
+    def retry_delay(self, response: Optional[Response], attempt: int) -> float:
+        backoff_s = min(self.max_backoff_s, self.base_backoff_s * (2 ** attempt))
+        delay_s = backoff_s / 2 + random.uniform(0, backoff_s / 2)
+
+        if response is not None:
+            retry_after_s = _retry_after_s(response.headers.get("Retry-After"))
+            if retry_after_s is None:
+                retry_after_s = _reset_after_s(response.headers.get("X-RateLimit-Reset"))
+            if retry_after_s is not None:
+                delay_s = retry_after_s + random.uniform(0, 1)
+        return delay_s
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate_per_s)
+        self._last_refill = now
+
+
+def _header_float(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _retry_after_s(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    seconds = _header_float(value)
+    if seconds is not None:
+        return max(0.0, seconds)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _reset_after_s(value: Optional[str]) -> Optional[float]:
+    reset = _header_float(value)
+    if reset is None:
+        return None
+    # Either an epoch timestamp or a number of seconds until the window resets
+    if reset > time.time() / 2:
+        return max(0.0, reset - time.time())
+    return max(0.0, reset)
@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+
+class ResultCache:
+    """
+    In-process LRU cache of serialized query results. Entries expire after ttl_s and are
+    only served while the data version they were computed against is still current.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_s: float = 300):
+        self.max_entries = max(1, max_entries)
+        self.ttl_s = ttl_s
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries: "OrderedDict[Hashable, Tuple[float, Optional[str], bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, data_version: Optional[str]) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, stored_version, value = entry
+                if stored_version == data_version and time.monotonic() - stored_at < self.ttl_s:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, data_version: Optional[str], value: bytes) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), data_version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+            }
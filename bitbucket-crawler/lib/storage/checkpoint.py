@@ -0,0 +1,100 @@
+import sqlite3
+from datetime import datetime
+from typing import Optional, Set
+
+from .schema import CRAWL_CHECKPOINT_TABLE, CRAWL_STATE_TABLE
+from .writer import BatchWriter
+
+__all__ = ['CrawlCheckpoint', 'DATA_VERSION_KEY']
+
+RUNNING = "running"
+FINISHED = "finished"
+PENDING = "pending"
+DONE = "done"
+
+DATA_VERSION_KEY = "data_version"
+
+
+class CrawlCheckpoint:
+    """
+    Persists crawl progress next to the crawled data. Checkpoint rows go through the same
+    BatchWriter as the rows they describe, so a page is only marked as stored once the
+    transaction holding it has been committed.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, writer: BatchWriter):
+        self.conn = conn
+        self.writer = writer
+        self.resumed = False
+
+    def begin_run(self, force_full: bool = False) -> bool:
+        self.writer.flush()
+        status = self._state("run_status")
+        self.resumed = status == RUNNING and not force_full
+
+        if self.resumed:
+            print(f"Resuming crawl started at {self._state('run_started_ts')}")
+        else:
+            if status == RUNNING:
+                print("Discarding checkpoint of unfinished crawl, starting a full crawl")
+            with self.conn:
+                self.conn.execute(f"DELETE FROM {CRAWL_CHECKPOINT_TABLE}")
+                self.conn.execute(f"DELETE FROM {CRAWL_STATE_TABLE} WHERE key LIKE 'phase:%'")
+            self._set_state("run_started_ts", datetime.now().isoformat())
+            self._set_state("run_status", RUNNING)
+            self.writer.flush()
+        return self.resumed
+
+    def finish_run(self) -> None:
+        # Readers use the data version to tell that cached query results are stale
+        data_version = int(self._state(DATA_VERSION_KEY) or 0) + 1
+        self._set_state("run_finished_ts", datetime.now().isoformat())
+        self._set_state("run_status", FINISHED)
+        self._set_state(DATA_VERSION_KEY, str(data_version))
+        self.writer.flush()
+
+    def is_phase_done(self, phase: str) -> bool:
+        return self._state(f"phase:{phase}") == DONE
+
+    def phase_done(self, phase: str) -> None:
+        self._set_state(f"phase:{phase}", DONE)
+        self.writer.flush()
+
+    def completed_items(self, phase: str) -> Set[str]:
+        rows = self.conn.execute(
+            f"SELECT item FROM {CRAWL_CHECKPOINT_TABLE} WHERE phase = ? AND status = ?", (phase, DONE)
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def cursor(self, phase: str, item: str) -> Optional[str]:
+        row = self.conn.execute(
+            f"SELECT cursor FROM {CRAWL_CHECKPOINT_TABLE} WHERE phase = ? AND item = ? AND status = ?",
+            (phase, item, PENDING)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def page_done(self, phase: str, item: str, next_cursor: Optional[str]) -> None:
+        self._set_item(phase, item, PENDING if next_cursor is not None else DONE, next_cursor)
+
+    def item_done(self, phase: str, item: str) -> None:
+        self._set_item(phase, item, DONE, None)
+
+    def _set_item(self, phase: str, item: str, status: str, cursor: Optional[str]) -> None:
+        self.writer.add(CRAWL_CHECKPOINT_TABLE, {
+            "phase": phase,
+            "item": item,
+            "status": status,
+            "cursor": cursor,
+            "update_ts": datetime.now().isoformat(),
+        }, replace=True)
+
+    def _state(self, key: str) -> Optional[str]:
+        row = self.conn.execute(f"SELECT value FROM {CRAWL_STATE_TABLE} WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_state(self, key: str, value: str) -> None:
+        self.writer.add(CRAWL_STATE_TABLE, {
+            "key": key,
+            "value": value,
+            "update_ts": datetime.now().isoformat(),
+        }, replace=True)
@@ -0,0 +1,102 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Tuple
+
+__all__ = ['configure_writer', 'checkpoint_wal', 'connect_readonly', 'ReadOnlyConnectionPool']
+
+
+def configure_writer(conn: sqlite3.Connection, journal_mode: str = "WAL", synchronous: str = "NORMAL",
+                     busy_timeout_ms: int = 5000, wal_autocheckpoint: int = 1000) -> str:
+    # In WAL mode readers keep reading the last committed snapshot while the writer appends,
+    # and with synchronous=NORMAL a commit no longer waits for an fsync of the database file
+    conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout_ms)}")
+    mode = conn.execute(f"PRAGMA journal_mode = {journal_mode}").fetchone()[0]
+    conn.execute(f"PRAGMA synchronous = {synchronous}")
+    conn.execute(f"PRAGMA wal_autocheckpoint = {int(wal_autocheckpoint)}")
+    return mode
+
+
+def checkpoint_wal(conn: sqlite3.Connection, mode: str = "PASSIVE") -> Tuple[int, int, int]:
+    # Returns (busy, wal pages, pages checkpointed); busy is 1 when readers held back a blocking checkpoint
+    if conn.in_transaction:
+        conn.commit()
+    return tuple(conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
+
+
+def connect_readonly(path: str, busy_timeout_ms: int = 5000) -> sqlite3.Connection:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout_ms)}")
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+class ReadOnlyConnectionPool:
+    """
+    Reuses read-only connections across requests instead of opening the database for
+    each one. Connections are created lazily, up to size, and handed out one per caller.
+    """
+
+    def __init__(self, path: str, size: int = 8, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.size = max(1, size)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._acquire()
+        discard = False
+        try:
+            yield conn
+        except sqlite3.Error:
+            # Do not hand a connection in an unknown state to the next request
+            discard = True
+            raise
+        finally:
+            if discard:
+                conn.close()
+                with self._lock:
+                    self._created -= 1
+            else:
+                self._idle.put(conn)
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def reset(self) -> None:
+        # Called in a freshly forked process: inherited connections belong to the parent and
+        # are dropped without being closed, new ones are opened on demand
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if not can_create:
+            return self._idle.get()
+
+        try:
+            return connect_readonly(self.path, busy_timeout_ms=self.busy_timeout_ms)
+        except sqlite3.Error:
+            with self._lock:
+                self._created -= 1
+            raise
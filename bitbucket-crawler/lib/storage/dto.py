@@ -1,11 +1,26 @@
+import operator
+import random
+from typing import Callable, Dict, Optional, Tuple
+
 import attrs.validators
 from attrs import define, field
 from sqlite_integrated import DatabaseEntry
 
-__all__ = ['Commit', 'Branch', 'Repo', 'RepoBranchLink', 'BranchCommitLink']
+__all__ = [
+    'Commit', 'Branch', 'Repo', 'RepoBranchLink', 'BranchCommitLink', 'VALIDATION_MODES', 'configure_validation',
+    'columns_of', 'row_of'
+]
+
+# on: every field is checked when a record is created, off: never, sampled: a fraction of the records
+# is checked when it is converted to a row and failures are reported instead of raised
+VALIDATION_MODES = ("on", "off", "sampled")
 
+_validation_mode = "on"
+_validation_sample_rate = 0.0
+_row_getters: Dict[type, Tuple[Tuple[str, ...], Callable[[object], tuple]]] = {}
 
-@define
+
+@define(weakref_slot=False)
 class Commit:
     hash: str = field(validator=attrs.validators.instance_of(str))
     message: str = field(validator=attrs.validators.instance_of(str))
@@ -30,12 +45,15 @@ class Commit:
         )
 
 
-@define
+@define(weakref_slot=False)
 class Branch:
     name: str = field(validator=attrs.validators.instance_of(str))
     repo: str = field(validator=attrs.validators.instance_of(str))
     url: str = field(validator=attrs.validators.instance_of(str))
     update_ts: str = field(validator=attrs.validators.instance_of(str))
+    head_hash: Optional[str] = field(
+        default=None, validator=attrs.validators.optional(attrs.validators.instance_of(str))
+    )
 
     @classmethod
     def from_db_entry(cls, db_entry: DatabaseEntry):
@@ -43,11 +61,12 @@ class Branch:
             name=db_entry.get('name'),
             repo=db_entry.get('repo'),
             url=db_entry.get('url'),
-            update_ts=db_entry.get('update_ts')
+            update_ts=db_entry.get('update_ts'),
+            head_hash=db_entry.get('head_hash')
         )
 
 
-@define
+@define(weakref_slot=False)
 class Repo:
     name: str = field(validator=attrs.validators.instance_of(str))
     workspace: str = field(validator=attrs.validators.instance_of(str))
@@ -55,6 +74,9 @@ class Repo:
     main_branch_url: str = field(validator=attrs.validators.instance_of(str))
     repo_url: str = field(validator=attrs.validators.instance_of(str))
     update_ts: str = field(validator=attrs.validators.instance_of(str))
+    updated_on: Optional[str] = field(
+        default=None, validator=attrs.validators.optional(attrs.validators.instance_of(str))
+    )
 
     @classmethod
     def from_db_entry(cls, db_entry: DatabaseEntry):
@@ -64,11 +86,12 @@ class Repo:
             main_branch=db_entry.get('main_branch'),
             main_branch_url=db_entry.get('main_branch_url'),
             repo_url=db_entry.get('repo_url'),
-            update_ts=db_entry.get('update_ts')
+            update_ts=db_entry.get('update_ts'),
+            updated_on=db_entry.get('updated_on')
         )
 
 
-@define
+@define(weakref_slot=False)
 class RepoBranchLink:
     repo_name: str = field(validator=attrs.validators.instance_of(str))
     branch_name: str = field(validator=attrs.validators.instance_of(str))
@@ -81,7 +104,7 @@ class RepoBranchLink:
         )
 
 
-@define
+@define(weakref_slot=False)
 class BranchCommitLink:
     branch_name: str = field(validator=attrs.validators.instance_of(str))
     commit_hash: str = field(validator=attrs.validators.instance_of(str))
@@ -92,3 +115,44 @@ class BranchCommitLink:
             branch_name=db_entry.get('branch_name'),
             commit_hash=db_entry.get('commit_hash')
         )
+
+
+def configure_validation(mode: str = "on", sample_rate: float = 0.01) -> None:
+    global _validation_mode
+    global _validation_sample_rate
+
+    if mode not in VALIDATION_MODES:
+        raise ValueError(f"Unknown validation mode {mode}. Possible modes: {','.join(VALIDATION_MODES)}")
+    _validation_mode = mode
+    _validation_sample_rate = sample_rate
+    attrs.validators.set_disabled(mode != "on")
+
+
+def columns_of(dto_class: type) -> Tuple[str, ...]:
+    return _row_getter(dto_class)[0]
+
+
+def row_of(dto) -> tuple:
+    # Column order matches columns_of, so rows can go to the writer without building a dict
+    if _validation_mode == "sampled" and random.random() < _validation_sample_rate:
+        _validate(dto)
+    return _row_getter(type(dto))[1](dto)
+
+
+def _row_getter(dto_class: type) -> Tuple[Tuple[str, ...], Callable[[object], tuple]]:
+    getter = _row_getters.get(dto_class)
+    if getter is None:
+        columns = tuple(a.name for a in attrs.fields(dto_class))
+        getter = _row_getters[dto_class] = (columns, operator.attrgetter(*columns))
+    return getter
+
+
+def _validate(dto) -> None:
+    # attrs.validate is a no-op while validators are disabled, so run them directly
+    for a in attrs.fields(type(dto)):
+        if a.validator is None:
+            continue
+        try:
+            a.validator(dto, a, getattr(dto, a.name))
+        except (TypeError, ValueError) as e:
+            print(f"Invalid {type(dto).__name__} {a.name}: {e.args[0]}")
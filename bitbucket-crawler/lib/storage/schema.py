@@ -0,0 +1,290 @@
+import sqlite3
+from typing import Callable, List
+
+__all__ = [
+    'REPO_TABLE', 'BRANCH_TABLE', 'COMMIT_TABLE', 'REPO_BRANCH_LINKING_TABLE', 'BRANCH_COMMIT_LINKING_TABLE',
+    'BRANCH_HIGH_WATER_MARK_TABLE', 'BRANCH_HEAD_TABLE', 'REPO_CRAWL_MARK_TABLE', 'CRAWL_STATE_TABLE', 'CRAWL_CHECKPOINT_TABLE',
+    'AUTHOR_STATS_TABLE', 'AUTHOR_REPO_STATS_TABLE', 'MIGRATIONS', 'schema_version', 'migrate'
+]
+
+REPO_TABLE = "repos"
+BRANCH_TABLE = "branches"
+COMMIT_TABLE = "commits"
+
+REPO_BRANCH_LINKING_TABLE = "link_repo_branches"
+BRANCH_COMMIT_LINKING_TABLE = "link_branch_commits"
+BRANCH_HIGH_WATER_MARK_TABLE = "branch_high_water_marks"
+BRANCH_HEAD_TABLE = "branch_heads"
+REPO_CRAWL_MARK_TABLE = "repo_crawl_marks"
+
+CRAWL_STATE_TABLE = "crawl_state"
+CRAWL_CHECKPOINT_TABLE = "crawl_checkpoints"
+
+AUTHOR_STATS_TABLE = "author_stats"
+AUTHOR_REPO_STATS_TABLE = "author_repo_stats"
+
+
+def _create_tables(conn: sqlite3.Connection) -> None:
+    # Databases created before versioning already have these tables
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {REPO_TABLE} (
+            id integer PRIMARY KEY,
+            name text,
+            workspace text,
+            main_branch text,
+            main_branch_url text,
+            repo_url text,
+            update_ts text
+        )""")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {BRANCH_TABLE} (
+            id integer PRIMARY KEY,
+            name text,
+            repo text,
+            url text,
+            update_ts text
+        )""")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {COMMIT_TABLE} (
+            id integer PRIMARY KEY,
+            hash text,
+            message text,
+            summary text,
+            date text,
+            author text,
+            email text,
+            diff_link text,
+            repo_url text
+        )""")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {REPO_BRANCH_LINKING_TABLE} (
+            id integer PRIMARY KEY,
+            repo_name text,
+            branch_name text
+        )""")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {BRANCH_COMMIT_LINKING_TABLE} (
+            id integer PRIMARY KEY,
+            branch_name text,
+            commit_hash text
+        )""")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {BRANCH_HIGH_WATER_MARK_TABLE} (
+            id integer PRIMARY KEY,
+            repo text,
+            branch_name text,
+            commit_hash text,
+            commit_date text,
+            update_ts text
+        )""")
+
+
+def _create_unique_indexes(conn: sqlite3.Connection) -> None:
+    unique_keys = {
+        REPO_TABLE: ["repo_url"],
+        BRANCH_TABLE: ["repo", "name"],
+        COMMIT_TABLE: ["hash"],
+        REPO_BRANCH_LINKING_TABLE: ["repo_name", "branch_name"],
+        BRANCH_COMMIT_LINKING_TABLE: ["branch_name", "commit_hash"],
+        BRANCH_HIGH_WATER_MARK_TABLE: ["repo", "branch_name"],
+    }
+    for table, columns in unique_keys.items():
+        key = ", ".join(columns)
+        conn.execute(f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {key})")
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_{'_'.join(columns)} ON {table} ({key})")
+
+
+def _index_commit_email(conn: sqlite3.Connection) -> None:
+    conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{COMMIT_TABLE}_email ON {COMMIT_TABLE} (email)")
+
+
+def _create_crawl_checkpoint_tables(conn: sqlite3.Connection) -> None:
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CRAWL_STATE_TABLE} (
+            id integer PRIMARY KEY,
+            key text NOT NULL UNIQUE,
+            value text,
+            update_ts text
+        )""")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CRAWL_CHECKPOINT_TABLE} (
+            id integer PRIMARY KEY,
+            phase text NOT NULL,
+            item text NOT NULL,
+            status text NOT NULL,
+            cursor text,
+            update_ts text,
+            UNIQUE (phase, item)
+        )""")
+
+
+def _index_commit_email_repo(conn: sqlite3.Connection) -> None:
+    # Lets per-author repo counts and random sampling within a repo walk a single index range
+    conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{COMMIT_TABLE}_email_repo_url ON {COMMIT_TABLE} (email, repo_url)")
+
+
+def _track_repo_updates(conn: sqlite3.Connection) -> None:
+    # updated_on as reported by Bitbucket, and the updated_on a repo had when it was last crawled completely
+    conn.execute(f"ALTER TABLE {REPO_TABLE} ADD COLUMN updated_on text")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {REPO_CRAWL_MARK_TABLE} (
+            id integer PRIMARY KEY,
+            repo text NOT NULL UNIQUE,
+            updated_on text,
+            update_ts text
+        )""")
+
+
+def _track_branch_heads(conn: sqlite3.Connection) -> None:
+    # The head reported by /refs, and the head a branch had when its commits were last crawled completely
+    conn.execute(f"ALTER TABLE {BRANCH_TABLE} ADD COLUMN head_hash text")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {BRANCH_HEAD_TABLE} (
+            id integer PRIMARY KEY,
+            repo text NOT NULL,
+            branch_name text NOT NULL,
+            head_hash text,
+            update_ts text,
+            UNIQUE (repo, branch_name)
+        )""")
+
+
+def _create_author_stats(conn: sqlite3.Connection) -> None:
+    # Per author summaries keyed by lower case email, kept up to date by a trigger on every commit actually
+    # inserted. INSERT OR IGNORE of a known hash does not fire it, so re-crawls and shard merges count once.
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {AUTHOR_STATS_TABLE} (
+            id integer PRIMARY KEY,
+            email text NOT NULL UNIQUE,
+            author text,
+            commits integer NOT NULL DEFAULT 0,
+            repos integer NOT NULL DEFAULT 0,
+            first_commit_date text,
+            last_commit_date text
+        )""")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {AUTHOR_REPO_STATS_TABLE} (
+            id integer PRIMARY KEY,
+            email text NOT NULL,
+            repo_url text NOT NULL,
+            commits integer NOT NULL DEFAULT 0,
+            first_commit_date text,
+            last_commit_date text,
+            UNIQUE (email, repo_url)
+        )""")
+
+    conn.execute(f"""
+        INSERT OR IGNORE INTO {AUTHOR_REPO_STATS_TABLE} (email, repo_url, commits, first_commit_date, last_commit_date)
+        SELECT lower(email), repo_url, COUNT(*), MIN(date), MAX(date) FROM {COMMIT_TABLE}
+        WHERE email IS NOT NULL AND repo_url IS NOT NULL
+        GROUP BY lower(email), repo_url""")
+    conn.execute(f"""
+        INSERT OR IGNORE INTO {AUTHOR_STATS_TABLE} (email, commits, repos, first_commit_date, last_commit_date)
+        SELECT email, SUM(commits), COUNT(*), MIN(first_commit_date), MAX(last_commit_date)
+        FROM {AUTHOR_REPO_STATS_TABLE} GROUP BY email""")
+    conn.execute(f"""
+        UPDATE {AUTHOR_STATS_TABLE} SET author = (
+            SELECT author FROM {COMMIT_TABLE} c WHERE c.email = {AUTHOR_STATS_TABLE}.email
+            ORDER BY c.date DESC LIMIT 1
+        )""")
+
+    conn.execute(_author_stats_trigger())
+
+
+def _author_stats_trigger(extra_statements: str = "") -> str:
+    # The author row goes first: a repo is new to the author while it has no author_repo_stats row yet.
+    # Dates are ISO 8601 strings, so text comparison orders them.
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS tr_{COMMIT_TABLE}_author_stats AFTER INSERT ON {COMMIT_TABLE}
+        WHEN NEW.email IS NOT NULL AND NEW.repo_url IS NOT NULL
+        BEGIN
+            INSERT INTO {AUTHOR_STATS_TABLE} (email, author, commits, repos, first_commit_date, last_commit_date)
+            VALUES (lower(NEW.email), NEW.author, 1, 1, NEW.date, NEW.date)
+            ON CONFLICT (email) DO UPDATE SET
+                commits = commits + 1,
+                repos = repos + NOT EXISTS (
+                    SELECT 1 FROM {AUTHOR_REPO_STATS_TABLE} WHERE email = excluded.email AND repo_url = NEW.repo_url
+                ),
+                author = CASE WHEN last_commit_date IS NULL OR excluded.last_commit_date >= last_commit_date
+                              THEN excluded.author ELSE author END,
+                first_commit_date = COALESCE(min(first_commit_date, excluded.first_commit_date),
+                                             first_commit_date, excluded.first_commit_date),
+                last_commit_date = COALESCE(max(last_commit_date, excluded.last_commit_date),
+                                            last_commit_date, excluded.last_commit_date);
+            INSERT INTO {AUTHOR_REPO_STATS_TABLE} (email, repo_url, commits, first_commit_date, last_commit_date)
+            VALUES (lower(NEW.email), NEW.repo_url, 1, NEW.date, NEW.date)
+            ON CONFLICT (email, repo_url) DO UPDATE SET
+                commits = commits + 1,
+                first_commit_date = COALESCE(min(first_commit_date, excluded.first_commit_date),
+                                             first_commit_date, excluded.first_commit_date),
+                last_commit_date = COALESCE(max(last_commit_date, excluded.last_commit_date),
+                                            last_commit_date, excluded.last_commit_date);
+            {extra_statements}
+        END"""
+
+
+def _sequence_author_repo_commits(conn: sqlite3.Connection) -> None:
+    # seq numbers an author's commits in a repo 1..author_repo_stats.commits without gaps, so a uniform sample
+    # is a set of uniform numbers in that range. Row ids are no good for that: an incremental crawl leaves
+    # large gaps between an author's older and newer commits.
+    conn.execute(f"ALTER TABLE {COMMIT_TABLE} ADD COLUMN seq integer")
+    conn.execute("CREATE TEMP TABLE commit_seqs (id integer PRIMARY KEY, seq integer)")
+    conn.execute(f"""
+        INSERT INTO temp.commit_seqs (id, seq)
+        SELECT id, ROW_NUMBER() OVER (PARTITION BY lower(email), repo_url ORDER BY id) FROM {COMMIT_TABLE}
+        WHERE email IS NOT NULL AND repo_url IS NOT NULL""")
+    conn.execute(f"""
+        UPDATE {COMMIT_TABLE} SET seq = (SELECT seq FROM temp.commit_seqs WHERE commit_seqs.id = {COMMIT_TABLE}.id)
+        WHERE email IS NOT NULL AND repo_url IS NOT NULL""")
+    conn.execute("DROP TABLE temp.commit_seqs")
+
+    # Supersedes the (email, repo_url) index
+    conn.execute(
+        f"CREATE INDEX IF NOT EXISTS ix_{COMMIT_TABLE}_email_repo_url_seq ON {COMMIT_TABLE} (email, repo_url, seq)"
+    )
+    conn.execute(f"DROP INDEX IF EXISTS ix_{COMMIT_TABLE}_email_repo_url")
+
+    # The repo row has just been counted, its commits is the new commit's seq
+    conn.execute(f"DROP TRIGGER IF EXISTS tr_{COMMIT_TABLE}_author_stats")
+    conn.execute(_author_stats_trigger(f"""UPDATE {COMMIT_TABLE} SET seq = (
+                SELECT commits FROM {AUTHOR_REPO_STATS_TABLE} WHERE email = lower(NEW.email) AND repo_url = NEW.repo_url
+            ) WHERE id = NEW.id;"""))
+
+
+# Append only: a database at version N has had the first N migrations applied
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _create_tables,
+    _create_unique_indexes,
+    _index_commit_email,
+    _create_crawl_checkpoint_tables,
+    _index_commit_email_repo,
+    _track_repo_updates,
+    _track_branch_heads,
+    _create_author_stats,
+    _sequence_author_repo_commits,
+]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    version = schema_version(conn)
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f"Database schema version {version} is newer than supported version {len(MIGRATIONS)}")
+
+    for target_version in range(version + 1, len(MIGRATIONS) + 1):
+        migration = MIGRATIONS[target_version - 1]
+        print(f"Migrating database schema to version {target_version}: {migration.__name__.strip('_')}")
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target_version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return len(MIGRATIONS)
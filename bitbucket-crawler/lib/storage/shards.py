@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import zlib
+from typing import List
+
+from .schema import *
+
+__all__ = ['SHARD_KEYS', 'shard_of', 'shard_database_file', 'seed_shard', 'merge_shard', 'remove_database_files']
+
+# repo: spread repos evenly, workspace: keep all repos of a workspace in one shard
+SHARD_KEYS = ("repo", "workspace")
+
+# Tables a shard crawls into, with how rows already in the main database are treated. Author stats are not
+# merged: the commits trigger maintains them in the main database as the shard's new commits arrive.
+MERGED_TABLES = {
+    BRANCH_TABLE: "INSERT OR REPLACE",
+    COMMIT_TABLE: "INSERT OR IGNORE",
+    REPO_BRANCH_LINKING_TABLE: "INSERT OR IGNORE",
+    BRANCH_COMMIT_LINKING_TABLE: "INSERT OR IGNORE",
+    BRANCH_HIGH_WATER_MARK_TABLE: "INSERT OR REPLACE",
+    BRANCH_HEAD_TABLE: "INSERT OR REPLACE",
+    REPO_CRAWL_MARK_TABLE: "INSERT OR REPLACE",
+}
+
+# Per repo crawl state a shard needs from the main database
+SEEDED_TABLES = [BRANCH_HIGH_WATER_MARK_TABLE, BRANCH_HEAD_TABLE, REPO_CRAWL_MARK_TABLE]
+
+
+def shard_of(workspace: str, name: str, shards: int, shard_by: str = "repo") -> int:
+    # crc32 rather than hash(): it has to agree between processes
+    key = workspace if shard_by == "workspace" else f"{workspace}/{name}"
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+def shard_database_file(database_dir: str, shard_index: int, shards: int) -> str:
+    return os.path.join(database_dir, "shards", f"shard-{shard_index}-of-{shards}.db")
+
+
+def seed_shard(conn: sqlite3.Connection, main_database_file: str, shard_index: int, shards: int,
+               shard_by: str = "repo") -> int:
+    # Copies the repos of one shard and their crawl state from the main database into a staging database
+    conn.create_function("shard_of", 2, lambda workspace, name: shard_of(workspace, name, shards, shard_by),
+                         deterministic=True)
+    repo_columns = _columns(conn, REPO_TABLE)
+
+    _attach(conn, main_database_file, "main_db")
+    try:
+        with conn:
+            conn.execute(
+                f"INSERT OR IGNORE INTO {REPO_TABLE} ({', '.join(repo_columns)}) "
+                f"SELECT {', '.join(repo_columns)} FROM main_db.{REPO_TABLE} WHERE shard_of(workspace, name) = ?",
+                (shard_index,)
+            )
+            for table in SEEDED_TABLES:
+                columns = ", ".join(_columns(conn, table))
+                conn.execute(
+                    f"INSERT OR IGNORE INTO {table} ({columns}) SELECT {columns} FROM main_db.{table} "
+                    f"WHERE repo IN (SELECT name FROM {REPO_TABLE})"
+                )
+    finally:
+        conn.execute("DETACH DATABASE main_db")
+    return conn.execute(f"SELECT COUNT(*) FROM {REPO_TABLE}").fetchone()[0]
+
+
+def merge_shard(conn: sqlite3.Connection, shard_database_file: str) -> None:
+    # One transaction per shard, so a shard is either fully merged or not at all
+    _attach(conn, shard_database_file, "shard_db")
+    try:
+        with conn:
+            for table, verb in MERGED_TABLES.items():
+                columns = ", ".join(_columns(conn, table))
+                conn.execute(f"{verb} INTO {table} ({columns}) SELECT {columns} FROM shard_db.{table} ORDER BY id")
+    finally:
+        conn.execute("DETACH DATABASE shard_db")
+
+
+def remove_database_files(database_file: str) -> None:
+    for path in (database_file, f"{database_file}-wal", f"{database_file}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _attach(conn: sqlite3.Connection, database_file: str, alias: str) -> None:
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute(f"ATTACH DATABASE ? AS {alias}", (database_file,))
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})") if row[1] != "id"]
@@ -0,0 +1,65 @@
+import sqlite3
+import time
+from typing import Dict, List, Tuple
+
+from ..Metrics import Metrics
+from .connection import checkpoint_wal
+
+__all__ = ['BatchWriter']
+
+
+class BatchWriter:
+    """
+    Buffers rows per table and writes them with executemany inside a single transaction.
+    Rows are inserted with INSERT OR IGNORE, so deduplication relies on the unique
+    indexes of the target tables instead of a lookup per row.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, flush_size: int = 500, flush_interval_s: float = 5.0,
+                 checkpoint_interval_s: float = 0):
+        self.conn = conn
+        self.flush_size = max(1, flush_size)
+        self.flush_interval_s = flush_interval_s
+        self.checkpoint_interval_s = checkpoint_interval_s
+
+        self._buffers: Dict[Tuple[str, str, Tuple[str, ...]], List[tuple]] = {}
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+        self._last_checkpoint = time.monotonic()
+
+    def add(self, table: str, row: dict, replace: bool = False) -> None:
+        columns = tuple(c for c in row.keys() if c != "id")
+        self.add_row(table, columns, tuple(row[c] for c in columns), replace=replace)
+
+    def add_row(self, table: str, columns: Tuple[str, ...], row: tuple, replace: bool = False) -> None:
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        self._buffers.setdefault((verb, table, columns), []).append(row)
+        self._buffered += 1
+
+        if self._buffered >= self.flush_size or time.monotonic() - self._last_flush >= self.flush_interval_s:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buffered > 0:
+            started = time.perf_counter()
+            inserted: Dict[str, int] = {}
+            with self.conn:
+                for (verb, table, columns), rows in self._buffers.items():
+                    placeholders = ", ".join("?" for _ in columns)
+                    cursor = self.conn.executemany(
+                        f'{verb} INTO {table} ({", ".join(columns)}) VALUES ({placeholders})', rows
+                    )
+                    inserted[table] = inserted.get(table, 0) + max(0, cursor.rowcount)
+                    Metrics.inc("rows_submitted_total", len(rows), table=table)
+            for table, count in inserted.items():
+                Metrics.inc("rows_inserted_total", count, table=table)
+            Metrics.inc("write_flush_seconds_total", time.perf_counter() - started)
+            self._buffers = {}
+            self._buffered = 0
+        self._last_flush = time.monotonic()
+
+        # wal_autocheckpoint only runs when the WAL passes its page threshold; also checkpoint on a timer
+        # so readers do not have to scan a long WAL between crawler bursts
+        if self.checkpoint_interval_s > 0 and self._last_flush - self._last_checkpoint >= self.checkpoint_interval_s:
+            checkpoint_wal(self.conn, "PASSIVE")
+            self._last_checkpoint = self._last_flush
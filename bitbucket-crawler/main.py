@@ -1,17 +1,35 @@
+import functools
+import subprocess
 import sys
 import traceback
 from datetime import datetime
 from pathlib import Path
+from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Set
 from typing import Tuple
 
-import attrs
 from sqlite_integrated import *
 
+from lib.ApiFields import ApiFields
+from lib.BitbucketClient import BitbucketClient
 from lib.BranchSource import BranchSource
 from lib.CommitSource import CommitSource
+from lib.CrawlPool import CrawlPool
+from lib.HttpCache import HttpCache
+from lib.JsonDecoder import JsonDecoder
+from lib.Metrics import Metrics
+from lib.Page import Page
+from lib.storage.checkpoint import CrawlCheckpoint
+from lib.storage.connection import checkpoint_wal, configure_writer
 from lib.storage.dto import *
+from lib.storage.schema import *
+from lib.storage.shards import *
+from lib.storage.writer import BatchWriter
 from lib.RepoSource import RepoSource
+from lib.RequestScheduler import RequestScheduler
 
 environment_variables = os.environ.copy()
 
@@ -27,275 +45,527 @@ BRANCH_PAGE_LIMIT = int(environment_variables.get('BRANCH_PAGE_LIMIT', '1'))
 COMMIT_PAGE_LIMIT = int(environment_variables.get('COMMIT_PAGE_LIMIT', '1'))
 MAIN_BRANCH_ONLY = True if environment_variables.get('MAIN_BRANCH_ONLY', 'true').lower() == 'true' else False
 DB_SILENT = bool(environment_variables.get('DB_SILENT', 'true'))
+FORCE_FULL_CRAWL = True if environment_variables.get('FORCE_FULL_CRAWL', 'false').lower() == 'true' else False
+INCREMENTAL_CRAWL = True if environment_variables.get('INCREMENTAL_CRAWL', 'false').lower() == 'true' else False
+BRANCH_UNIQUE_COMMITS_ONLY = True if environment_variables.get('BRANCH_UNIQUE_COMMITS_ONLY', 'true').lower() == 'true' else False
+SKIP_UNCHANGED_REPOS = True if environment_variables.get('SKIP_UNCHANGED_REPOS', 'false').lower() == 'true' else False
+SKIP_UNCHANGED_BRANCHES = True if environment_variables.get('SKIP_UNCHANGED_BRANCHES', 'true').lower() == 'true' else False
+CRAWL_CONCURRENCY = int(environment_variables.get('CRAWL_CONCURRENCY', '1'))
+CRAWL_QUEUE_SIZE = int(environment_variables.get('CRAWL_QUEUE_SIZE', str(4 * CRAWL_CONCURRENCY)))
+WRITE_BATCH_SIZE = int(environment_variables.get('WRITE_BATCH_SIZE', '500'))
+WRITE_FLUSH_INTERVAL_S = float(environment_variables.get('WRITE_FLUSH_INTERVAL_S', '5'))
+BITBUCKET_API_URL = environment_variables.get('BITBUCKET_API_URL', 'https://api.bitbucket.org/2.0')
+COMMIT_PAGE_FANOUT = int(environment_variables.get('COMMIT_PAGE_FANOUT', '4'))
+HTTP_POOL_SIZE = int(
+    environment_variables.get('HTTP_POOL_SIZE', str(max(10, CRAWL_CONCURRENCY * COMMIT_PAGE_FANOUT)))
+)
+RATE_LIMIT_PER_HOUR = int(environment_variables.get('RATE_LIMIT_PER_HOUR', '1000'))
+REQUEST_MAX_RETRIES = int(environment_variables.get('REQUEST_MAX_RETRIES', '8'))
+REQUEST_MAX_BACKOFF_S = float(environment_variables.get('REQUEST_MAX_BACKOFF_S', '300'))
+HTTP_CACHE_DIR = environment_variables.get('HTTP_CACHE_DIR', '')
+HTTP_CACHE_MAX_MB = int(environment_variables.get('HTTP_CACHE_MAX_MB', '256'))
+API_FIELD_FILTER = True if environment_variables.get('API_FIELD_FILTER', 'true').lower() == 'true' else False
+JSON_BACKEND = environment_variables.get('JSON_BACKEND', 'auto').lower()
+CRAWL_SHARDS = int(environment_variables.get('CRAWL_SHARDS', '1'))
+CRAWL_SHARD_BY = environment_variables.get('CRAWL_SHARD_BY', 'repo').lower()
+# Set by the crawler itself on the processes it starts for each shard
+CRAWL_SHARD_INDEX = environment_variables.get('CRAWL_SHARD_INDEX', None)
+METRICS_FILE = environment_variables.get('METRICS_FILE', '')
+METRICS_SUMMARY_FILE = environment_variables.get('METRICS_SUMMARY_FILE', os.path.join(DATABASE_DIR or '', 'crawl-metrics.json'))
+METRICS_PORT = int(environment_variables.get('METRICS_PORT', '0'))
+DTO_VALIDATION = environment_variables.get('DTO_VALIDATION', 'sampled').lower()
+DTO_VALIDATION_SAMPLE_RATE = float(environment_variables.get('DTO_VALIDATION_SAMPLE_RATE', '0.01'))
+DB_JOURNAL_MODE = environment_variables.get('DB_JOURNAL_MODE', 'WAL')
+DB_SYNCHRONOUS = environment_variables.get('DB_SYNCHRONOUS', 'NORMAL')
+DB_BUSY_TIMEOUT_MS = int(environment_variables.get('DB_BUSY_TIMEOUT_MS', '5000'))
+DB_WAL_AUTOCHECKPOINT = int(environment_variables.get('DB_WAL_AUTOCHECKPOINT', '1000'))
+DB_CHECKPOINT_INTERVAL_S = float(environment_variables.get('DB_CHECKPOINT_INTERVAL_S', '60'))
 
 if BITBUCKET_USERNAME is None or BITBUCKET_PASSWORD is None or DATABASE_DIR is None:
     print("Set required environment variables: BITBUCKET_USERNAME, BITBUCKET_PASSWORD, DATABASE_DIR")
     sys.exit(1)
 
-REPO_TABLE = "repos"
-BRANCH_TABLE = "branches"
-COMMIT_TABLE = "commits"
+if CRAWL_SHARD_BY not in SHARD_KEYS:
+    print(f"Set CRAWL_SHARD_BY to one of: {', '.join(SHARD_KEYS)}")
+    sys.exit(1)
+
+DATABASE_PATH = Path(os.getcwd()).joinpath(DATABASE_DIR)
+DATABASE_FILE = os.path.join(DATABASE_PATH, "database.db")
+
+REPO_COLUMNS = columns_of(Repo)
+BRANCH_COLUMNS = columns_of(Branch)
+COMMIT_COLUMNS = columns_of(Commit)
+REPO_BRANCH_LINK_COLUMNS = columns_of(RepoBranchLink)
+BRANCH_COMMIT_LINK_COLUMNS = columns_of(BranchCommitLink)
 
-REPO_BRANCH_LINKING_TABLE = "link_repo_branches"
-BRANCH_COMMIT_LINKING_TABLE = "link_branch_commits"
+REPOS_PHASE = "repos"
+BRANCHES_PHASE = "branches"
+COMMITS_PHASE = "commits"
+SHARDS_PHASE = "shards"
+REPOSITORIES_ITEM = "repositories"
 
 db: Database
+writer: BatchWriter
+checkpoint: CrawlCheckpoint
 
 
-def create_database() -> None:
+def create_database(database_file: str = DATABASE_FILE) -> None:
     global db
+    global writer
+    global checkpoint
 
-    DATABASE_PATH = Path(os.getcwd()).joinpath(DATABASE_DIR)
-    DATABASE_FILE = os.path.join(DATABASE_PATH, "database.db")
+    database_path = Path(database_file).parent
+    if not database_path.exists():
+        os.makedirs(database_path, exist_ok=True)
 
-    if not DATABASE_PATH.exists():
-        os.makedirs(DATABASE_PATH, exist_ok=True)
-
-    create_new = False if os.path.exists(DATABASE_FILE) else True
+    create_new = False if os.path.exists(database_file) else True
     if create_new:
-        print(f"Creating new database {DATABASE_FILE}")
+        print(f"Creating new database {database_file}")
     else:
-        print(f"Using existing database {DATABASE_FILE}")
-
-    db = Database(DATABASE_FILE, new=create_new, silent=DB_SILENT)
-
-    if not db.is_table(REPO_TABLE):
-        print("Creating Repo table")
-        db.create_table(
-            REPO_TABLE,
-            [
-                Column("id", "integer", primary_key=True),
-                Column("name", "string"),
-                Column("workspace", "string"),
-                Column("main_branch", "string"),
-                Column("main_branch_url", "string"),
-                Column("repo_url", "string"),
-                Column("update_ts", "string"),
-            ],
-        )
+        print(f"Using existing database {database_file}")
 
-    if not db.is_table(BRANCH_TABLE):
-        print("Creating branch table")
-        db.create_table(
-            BRANCH_TABLE,
-            [
-                Column("id", "integer", primary_key=True),
-                Column("name", "string"),
-                Column("repo", "string"),
-                Column("url", "string"),
-                Column("update_ts", "string"),
-            ],
-        )
+    db = Database(database_file, new=create_new, silent=DB_SILENT)
+    journal_mode = configure_writer(db.conn, journal_mode=DB_JOURNAL_MODE, synchronous=DB_SYNCHRONOUS,
+                                    busy_timeout_ms=DB_BUSY_TIMEOUT_MS, wal_autocheckpoint=DB_WAL_AUTOCHECKPOINT)
+    print(f"Database journal mode {journal_mode}")
+    version = migrate(db.conn)
+    print(f"Database schema version {version}")
 
-    if not db.is_table(COMMIT_TABLE):
-        print("Creating commit table")
-        db.create_table(
-            COMMIT_TABLE,
-            [
-                Column("id", "integer", primary_key=True),
-                Column("hash", "string"),
-                Column("message", "string"),
-                Column("summary", "string"),
-                Column("date", "string"),
-                Column("author", "string"),
-                Column("email", "string"),
-                Column("diff_link", "string"),
-                Column("repo_url", "string"),
-            ],
-        )
+    writer = BatchWriter(db.conn, flush_size=WRITE_BATCH_SIZE, flush_interval_s=WRITE_FLUSH_INTERVAL_S,
+                         checkpoint_interval_s=DB_CHECKPOINT_INTERVAL_S)
+    checkpoint = CrawlCheckpoint(db.conn, writer)
 
-    if not db.is_table(REPO_BRANCH_LINKING_TABLE):
-        print("Creating repo-branch linking table")
-        db.create_table(
-            REPO_BRANCH_LINKING_TABLE,
-            [
-                Column("id", "integer", primary_key=True),
-                Column("repo_name", "string"),
-                Column("branch_name", "string"),
-            ],
-        )
 
-    if not db.is_table(BRANCH_COMMIT_LINKING_TABLE):
-        print("Creating branch-commit linking table")
-        db.create_table(
-            BRANCH_COMMIT_LINKING_TABLE,
-            [
-                Column("id", "integer", primary_key=True),
-                Column("branch_name", "string"),
-                Column("commit_hash", "string"),
-            ],
+def journal_mode_is_wal() -> bool:
+    return db.conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+
+
+def get_high_water_mark(repo: Repo, branch: Branch) -> Optional[str]:
+    global db
+
+    row = db.cursor.execute(
+        f'SELECT commit_hash FROM {BRANCH_HIGH_WATER_MARK_TABLE} WHERE repo = ? AND branch_name = ?',
+        (repo.name, branch.name)
+    ).fetchone()
+    return None if row is None else row[0]
+
+
+def set_high_water_mark(repo: Repo, branch: Branch, commit: Commit) -> None:
+    global writer
+
+    writer.add(BRANCH_HIGH_WATER_MARK_TABLE, {
+        "repo": repo.name,
+        "branch_name": branch.name,
+        "commit_hash": commit.hash,
+        "commit_date": commit.date,
+        "update_ts": datetime.now().isoformat(),
+    }, replace=True)
+
+
+def clear_high_water_mark(repo: Repo, branch: Branch) -> None:
+    global db
+    global writer
+
+    writer.flush()
+    with db.conn:
+        db.conn.execute(
+            f'DELETE FROM {BRANCH_HIGH_WATER_MARK_TABLE} WHERE repo = ? AND branch_name = ?', (repo.name, branch.name)
         )
 
 
+def skip_unchanged_repos() -> bool:
+    return SKIP_UNCHANGED_REPOS and not FORCE_FULL_CRAWL
+
+
+def unchanged_repos() -> Set[str]:
+    # Repos Bitbucket has not updated since they were last crawled completely
+    rows = db.cursor.execute(
+        f'SELECT r.name FROM {REPO_TABLE} r JOIN {REPO_CRAWL_MARK_TABLE} m ON m.repo = r.name '
+        f'WHERE r.updated_on IS NOT NULL AND r.updated_on = m.updated_on'
+    ).fetchall()
+    return {row[0] for row in rows}
+
+
+def last_crawled_updated_on() -> Optional[str]:
+    row = db.cursor.execute(f'SELECT MAX(updated_on) FROM {REPO_CRAWL_MARK_TABLE}').fetchone()
+    return None if row is None else row[0]
+
+
+def set_repo_crawled(repo: Repo) -> None:
+    global writer
+
+    writer.add(REPO_CRAWL_MARK_TABLE, {
+        "repo": repo.name,
+        "updated_on": repo.updated_on,
+        "update_ts": datetime.now().isoformat(),
+    }, replace=True)
+
+
+def crawled_branch_heads() -> Dict[Tuple[str, str], str]:
+    rows = db.cursor.execute(f'SELECT repo, branch_name, head_hash FROM {BRANCH_HEAD_TABLE}').fetchall()
+    return {(repo_name, branch_name): head_hash for repo_name, branch_name, head_hash in rows}
+
+
+def set_branch_crawled(repo: Repo, branch: Branch) -> None:
+    global writer
+
+    writer.add(BRANCH_HEAD_TABLE, {
+        "repo": repo.name,
+        "branch_name": branch.name,
+        "head_hash": branch.head_hash,
+        "update_ts": datetime.now().isoformat(),
+    }, replace=True)
+
+
+@Metrics.timed("fetch_repos")
 def fetch_repos() -> None:
-    global db
+    global writer
+    global checkpoint
 
-    repo: Repo
-    repos = RepoSource.get_repos(BITBUCKET_USERNAME, BITBUCKET_PASSWORD, IGNORED_REPOS)
-    for i, repo in enumerate(repos):
-        repo_d = attrs.asdict(repo)
-        query = db.SELECT("name").FROM(REPO_TABLE).WHERE("repo_url").LIKE(repo.repo_url)
-        result: List[DatabaseEntry] = query.run()
-
-        if result is None or len(result) == 0:
-            # print(f"Inserting repo: {repo.name}")
-            db.add_entry(repo_d, REPO_TABLE)
-            db.save()
-        else:
-            print("Already added repo:", repo.name)
+    if checkpoint.is_phase_done(REPOS_PHASE):
+        print("Repositories already fetched in this crawl")
+        return
+
+    start_url = checkpoint.cursor(REPOS_PHASE, REPOSITORIES_ITEM)
+    # Repos not updated since the last complete crawl are already stored, no need to list them again
+    updated_since = last_crawled_updated_on() if skip_unchanged_repos() else None
+    page: Page[Repo]
+    for page in RepoSource.iter_repos(BITBUCKET_USERNAME, BITBUCKET_PASSWORD, IGNORED_REPOS, start_url=start_url,
+                                      updated_since=updated_since):
+        repo: Repo
+        for repo in page.values:
+            # Replaced, not ignored, to keep updated_on and the main branch current
+            writer.add_row(REPO_TABLE, REPO_COLUMNS, row_of(repo), replace=True)
+        checkpoint.page_done(REPOS_PHASE, REPOSITORIES_ITEM, page.next)
+    checkpoint.phase_done(REPOS_PHASE)
+
+
+def store_branch(repo: Repo, branch: Branch, link: RepoBranchLink) -> None:
+    global writer
+
+    # Replaced, not ignored, to keep the head hash current
+    writer.add_row(BRANCH_TABLE, BRANCH_COLUMNS, row_of(branch), replace=True)
+    writer.add_row(REPO_BRANCH_LINKING_TABLE, REPO_BRANCH_LINK_COLUMNS, row_of(link))
+
+
+def store_commit(branch: Branch, commit: Commit, link: BranchCommitLink) -> None:
+    global writer
 
+    writer.add_row(COMMIT_TABLE, COMMIT_COLUMNS, row_of(commit))
+    writer.add_row(BRANCH_COMMIT_LINKING_TABLE, BRANCH_COMMIT_LINK_COLUMNS, row_of(link))
 
+
+@Metrics.timed("fetch_repo_branches")
 def fetch_repo_branches() -> None:
     global db
+    global writer
+    global checkpoint
+
+    if checkpoint.is_phase_done(BRANCHES_PHASE):
+        print("Branches already fetched in this crawl")
+        return
 
     repo_query = db.SELECT("*").FROM(REPO_TABLE)
-    repo_query_results: List[DatabaseEntry] = repo_query.run()
+    # run() returns None rather than an empty list when nothing matches, e.g. in a shard without repos
+    repo_query_results: List[DatabaseEntry] = repo_query.run() or []
     repo_query_results.sort(key=lambda x: x.get('name'), reverse=False)
-
-    repo_query_result: DatabaseEntry
-    for ir, repo_query_result in enumerate(repo_query_results):
-        try:
-            repo = Repo.from_db_entry(repo_query_result)
-
-            if MAIN_BRANCH_ONLY:
+    completed_repos = checkpoint.completed_items(BRANCHES_PHASE)
+    if skip_unchanged_repos():
+        skipped_repos = unchanged_repos()
+        print(f"Skipping {len(skipped_repos)} repositories not updated since they were last crawled")
+        completed_repos |= skipped_repos
+    repos = [Repo.from_db_entry(r) for r in repo_query_results if r.get('name') not in completed_repos]
+
+    if MAIN_BRANCH_ONLY:
+        for repo in repos:
+            try:
                 branch = Branch(repo.main_branch, repo.name, repo.main_branch_url, datetime.now().isoformat())
                 link = RepoBranchLink(repo.name, repo.main_branch)
-
-                branch_d = attrs.asdict(branch)
-
-                branch_query = (db.SELECT("url").FROM(BRANCH_TABLE).WHERE("url").LIKE(branch.url))
-                branch_result: List[DatabaseEntry] = branch_query.run()
-                if branch_result is None or len(branch_result) == 0:
-                    db.add_entry(branch_d, BRANCH_TABLE)
-                    db.save()
-
-                link_d = attrs.asdict(link)
-                existing_link_sql = f'SELECT * FROM {REPO_BRANCH_LINKING_TABLE} ' \
-                                    f'WHERE repo_name == "{repo.name}" AND ' \
-                                    f'branch_name == "{branch.name}"'
-
-                existing_links = db.cursor.execute(existing_link_sql).fetchall()
-
-                if existing_links is None or len(existing_links) == 0:
-                    # print(f"Inserting repo branch link: {repo.name} -> {branch.name}")
-                    db.add_entry(link_d, REPO_BRANCH_LINKING_TABLE)
-                    db.save()
-            else:
-                print(f"{ir + 1}/{len(repo_query_results)}: Fetching branches for {repo.name}")
-
-                branch_and_link: Tuple[List[Branch], List[RepoBranchLink]]
-                branch_links = BranchSource.get_branches(BITBUCKET_USERNAME, BITBUCKET_PASSWORD, repo.workspace,
-                                                         repo.name, page_length=REQUEST_PAGE_SIZE,
-                                                         branch_page_limit=BRANCH_PAGE_LIMIT)
-                for ib, branch_and_link in enumerate(branch_links):
-                    branch: Branch
-                    link: RepoBranchLink
-                    branch, link = branch_and_link
-
-                    branch_d = attrs.asdict(branch)
-
-                    branch_query = (
-                        db.SELECT("url").FROM(BRANCH_TABLE).WHERE("url").LIKE(branch.url)
-                    )
-                    branch_result: List[DatabaseEntry] = branch_query.run()
-                    if branch_result is None or len(branch_result) == 0:
-                        # print(f"Inserting branch: {branch.name}")
-                        db.add_entry(branch_d, BRANCH_TABLE)
-                        db.save()
-
-                    link_d = attrs.asdict(link)
-                    existing_link_sql = f'SELECT * FROM {REPO_BRANCH_LINKING_TABLE} ' \
-                                        f'WHERE repo_name == "{repo.name}" AND ' \
-                                        f'branch_name == "{branch.name}"'
-
-                    existing_links = db.cursor.execute(existing_link_sql).fetchall()
-
-                    if existing_links is None or len(existing_links) == 0:
-                        # print(f"Inserting repo branch link: {repo.name} -> {branch.name}")
-                        db.add_entry(link_d, REPO_BRANCH_LINKING_TABLE)
-                        db.save()
-
-        except Exception:
-            print(f"An error occurred fetching branches")
-            traceback.print_exc()
-            print("Continuing")
-            pass
-
-
+                store_branch(repo, branch, link)
+                checkpoint.item_done(BRANCHES_PHASE, repo.name)
+            except Exception:
+                print(f"An error occurred fetching branches")
+                traceback.print_exc()
+                print("Continuing")
+        checkpoint.phase_done(BRANCHES_PHASE)
+        return
+
+    def branch_job(ir: int, repo: Repo, start_url: Optional[str]) -> Iterator[Page[Tuple[Branch, RepoBranchLink]]]:
+        print(f"{ir + 1}/{len(repos)}: Fetching branches for {repo.name}")
+        return BranchSource.iter_branches(BITBUCKET_USERNAME, BITBUCKET_PASSWORD, repo.workspace,
+                                          repo.name, page_length=REQUEST_PAGE_SIZE,
+                                          branch_page_limit=BRANCH_PAGE_LIMIT, start_url=start_url)
+
+    def store_branches(repo: Repo, page: Page[Tuple[Branch, RepoBranchLink]]) -> None:
+        branch_and_link: Tuple[Branch, RepoBranchLink]
+        for branch_and_link in page.values:
+            branch, link = branch_and_link
+            store_branch(repo, branch, link)
+        checkpoint.page_done(BRANCHES_PHASE, repo.name, page.next)
+
+    def repo_done(repo: Repo) -> None:
+        checkpoint.item_done(BRANCHES_PHASE, repo.name)
+
+    jobs = (
+        (repo, functools.partial(branch_job, ir, repo, checkpoint.cursor(BRANCHES_PHASE, repo.name)))
+        for ir, repo in enumerate(repos)
+    )
+    CrawlPool(CRAWL_CONCURRENCY, queue_size=CRAWL_QUEUE_SIZE).run(jobs, store_branches, on_done=repo_done)
+    checkpoint.phase_done(BRANCHES_PHASE)
+
+
+@Metrics.timed("fetch_branch_commits")
 def fetch_branch_commits() -> None:
     global db
+    global writer
+    global checkpoint
+
+    if checkpoint.is_phase_done(COMMITS_PHASE):
+        print("Commits already fetched in this crawl")
+        return
+
     repo_query = db.SELECT("*").FROM(REPO_TABLE)
-    repo_query_results: List[DatabaseEntry] = repo_query.run()
+    repo_query_results: List[DatabaseEntry] = repo_query.run() or []
     repo_query_results.sort(key=lambda x: x.get('name'), reverse=False)
-    repo_query_result: DatabaseEntry
-    for ir, repo_query_result in enumerate(repo_query_results):
 
-        branch_query = db.SELECT("*").FROM(BRANCH_TABLE).WHERE('repo').LIKE(repo_query_result.get('name'))
-        branch_query_results: List[DatabaseEntry] = branch_query.run()
+    newest_commits: Dict[Tuple[str, str], Commit] = {}
+    # Hashes stored per repo during this crawl, dropped once the last branch of the repo is done
+    seen_hashes: Dict[str, Set[str]] = {}
+    pending_branches: Dict[str, int] = {}
+
+    completed_branches = checkpoint.completed_items(COMMITS_PHASE)
+    skipped_repos = unchanged_repos() if skip_unchanged_repos() else set()
+    # Repos whose branch listing was fetched in this crawl. When it failed, the stored heads are stale and
+    # branches matching them prove nothing, so such a repo must not be marked crawled.
+    refreshed_repos = checkpoint.completed_items(BRANCHES_PHASE)
+    # Heads come from the refs listing, so finding unchanged branches costs no commit requests
+    branch_heads = crawled_branch_heads() if SKIP_UNCHANGED_BRANCHES and not FORCE_FULL_CRAWL else {}
+    unchanged_branches = 0
+
+    def branches_refreshed(repo: Repo) -> bool:
+        return MAIN_BRANCH_ONLY or repo.name in refreshed_repos
+
+    def commit_job(ir: int, ib: int, branch_count: int, repo: Repo, branch: Branch, known_commit_hash: Optional[str],
+                   start_page: int) -> Iterator[Page[Tuple[Commit, BranchCommitLink]]]:
+        print(
+            f"Repo [{ir + 1}/{len(repo_query_results)}] Branch [{ib + 1}/{branch_count}]: Fetching commits for branch {branch.name} of  {branch.repo}"
+        )
+        # The main branch is crawled in full, other branches only for the commits they add on top of it
+        exclude = None
+        if BRANCH_UNIQUE_COMMITS_ONLY and repo.main_branch and branch.name != repo.main_branch:
+            exclude = [repo.main_branch]
+        return CommitSource.iter_commits(
+            BITBUCKET_USERNAME, BITBUCKET_PASSWORD, repo, page_length=REQUEST_PAGE_SIZE, branch=branch,
+            commit_page_limit=COMMIT_PAGE_LIMIT, known_commit_hash=known_commit_hash, start_page=start_page,
+            exclude=exclude, seen_hashes=seen_hashes.setdefault(repo.name, set()), page_fanout=COMMIT_PAGE_FANOUT
+        )
+
+    def store_commits(key: Tuple[Repo, Branch], page: Page[Tuple[Commit, BranchCommitLink]]) -> None:
+        repo, branch = key
+        if page.known_commit_dropped and page.number == 1:
+            # The mark no longer exists in the repo, a resumed or later crawl must not exclude it again
+            clear_high_water_mark(repo, branch)
+        commit_and_link: Tuple[Commit, BranchCommitLink]
+        for commit_and_link in page.values:
+            commit, link = commit_and_link
+            store_commit(branch, commit, link)
+        seen_hashes.setdefault(repo.name, set()).update(commit.hash for commit, _ in page.values)
+
+        # Commit pages are numbered, so the cursor is the number of the next page
+        next_cursor = str(page.number + 1) if page.next is not None else None
+        checkpoint.page_done(COMMITS_PHASE, f"{repo.name}/{branch.name}", next_cursor)
+
+        if page.number == 1 and len(page.values) > 0:
+            newest_commits[(repo.name, branch.name)], _ = page.values[0]
+
+    def branch_done(key: Tuple[Repo, Branch]) -> None:
+        # Only advance the high-water mark once every page of the branch has been stored
+        repo, branch = key
+        newest_commit = newest_commits.pop((repo.name, branch.name), None)
+        if INCREMENTAL_CRAWL and newest_commit is not None:
+            set_high_water_mark(repo, branch, newest_commit)
+        checkpoint.item_done(COMMITS_PHASE, f"{repo.name}/{branch.name}")
+        if branch.head_hash is not None:
+            set_branch_crawled(repo, branch)
+
+        pending_branches[repo.name] -= 1
+        if pending_branches[repo.name] == 0:
+            seen_hashes.pop(repo.name, None)
+            # Every branch of the repo made it, so the next crawl may skip the repo while it stays unchanged
+            if branches_refreshed(repo):
+                set_repo_crawled(repo)
+
+    def commit_jobs():
+        nonlocal unchanged_branches
+
+        repo_query_result: DatabaseEntry
+        for ir, repo_query_result in enumerate(repo_query_results):
+            repo = Repo.from_db_entry(repo_query_result)
+            if repo.name in skipped_repos:
+                continue
 
-        branch_query_result: DatabaseEntry
-        for ib, branch_query_result in enumerate(branch_query_results):
-            try:
+            branch_query = db.SELECT("*").FROM(BRANCH_TABLE).WHERE('repo', repo.name)
+            branch_query_results: List[DatabaseEntry] = branch_query.run() or []
+            # Main branch first: the other branches only add to its history
+            branch_query_results.sort(key=lambda x: x.get('name') != repo.main_branch)
+
+            branch_query_result: DatabaseEntry
+            for ib, branch_query_result in enumerate(branch_query_results):
                 branch = Branch.from_db_entry(branch_query_result)
-                print(
-                    f"Repo [{ir + 1}/{len(repo_query_results)}] Branch [{ib + 1}/{len(branch_query_results)}]: Fetching commits for branch {branch.name} of  {branch.repo}"
-                )
-
-                repo_q: DatabaseEntry = list(
-                    filter(lambda r: r.get("name") == branch.repo, repo_query_results)
-                )[0]
-                repo = Repo.from_db_entry(repo_q)
-
-                commit_links = CommitSource.get_commits(
-                    BITBUCKET_USERNAME, BITBUCKET_PASSWORD, repo, page_length=REQUEST_PAGE_SIZE, branch=branch,
-                    commit_page_limit=COMMIT_PAGE_LIMIT
-                )
-                commit_and_link: Tuple[List[Commit], List[BranchCommitLink]]
-                for ci, commit_and_link in enumerate(commit_links):
-                    commit: Commit
-                    link: BranchCommitLink
-                    commit, link = commit_and_link
-
-                    commit_d = attrs.asdict(commit)
-                    link_d = attrs.asdict(link)
-                    query = (
-                        db.SELECT("diff_link")
-                        .FROM(COMMIT_TABLE)
-                        .WHERE("diff_link")
-                        .LIKE(commit.diff_link)
-                    )
-                    result: List[DatabaseEntry] = query.run()
-
-                    if result is None or len(result) == 0:
-                        # print(f"Inserting commit: {commit.diff_link}")
-                        db.add_entry(commit_d, COMMIT_TABLE)
-                        db.save()
-
-                    existing_link_sql = f'SELECT * FROM {BRANCH_COMMIT_LINKING_TABLE} WHERE branch_name == "{branch.name}" AND commit_hash == "{commit.hash}"'
-
-                    existing_links = db.cursor.execute(existing_link_sql).fetchall()
-
-                    if existing_links is None or len(existing_links) == 0:
-                        # print(f"Inserting branch commit link: {branch.name} -> {commit.hash}")
-                        db.add_entry(link_d, BRANCH_COMMIT_LINKING_TABLE)
-                        db.save()
+                item = f"{repo.name}/{branch.name}"
+                if item in completed_branches:
+                    continue
+                if branch.head_hash is not None and branch_heads.get((repo.name, branch.name)) == branch.head_hash:
+                    unchanged_branches += 1
+                    continue
+
+                cursor = checkpoint.cursor(COMMITS_PHASE, item)
+                start_page = 1 if cursor is None else int(cursor)
+                use_high_water_mark = INCREMENTAL_CRAWL and not FORCE_FULL_CRAWL
+                known_commit_hash = get_high_water_mark(repo, branch) if use_high_water_mark else None
+                pending_branches[repo.name] = pending_branches.get(repo.name, 0) + 1
+                yield (repo, branch), functools.partial(commit_job, ir, ib, len(branch_query_results), repo, branch,
+                                                        known_commit_hash, start_page)
+
+            if repo.name not in pending_branches and len(branch_query_results) > 0 and branches_refreshed(repo):
+                # Nothing left to fetch for this repo
+                set_repo_crawled(repo)
+
+    CrawlPool(CRAWL_CONCURRENCY, queue_size=CRAWL_QUEUE_SIZE).run(commit_jobs(), store_commits, on_done=branch_done)
+    if unchanged_branches > 0:
+        print(f"Skipped {unchanged_branches} branches whose head did not change since they were last crawled")
+    checkpoint.phase_done(COMMITS_PHASE)
+
+
+@Metrics.timed("crawl_shards")
+def crawl_shards() -> bool:
+    global db
+    global writer
+    global checkpoint
+
+    if checkpoint.is_phase_done(SHARDS_PHASE):
+        print("Shards already crawled and merged in this crawl")
+        return True
+
+    completed_shards = checkpoint.completed_items(SHARDS_PHASE)
+    processes: Dict[int, subprocess.Popen] = {}
+    for shard_index in range(CRAWL_SHARDS):
+        if f"shard-{shard_index}" in completed_shards:
+            continue
+        shard_file = shard_database_file(DATABASE_PATH, shard_index, CRAWL_SHARDS)
+        if not checkpoint.resumed:
+            # Left behind by an abandoned crawl
+            remove_database_files(shard_file)
+
+        print(f"Starting crawler for shard {shard_index + 1}/{CRAWL_SHARDS}")
+        shard_environment = dict(environment_variables, CRAWL_SHARD_INDEX=str(shard_index))
+        processes[shard_index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=shard_environment)
+
+    failed_shards = 0
+    for shard_index, process in processes.items():
+        exit_code = process.wait()
+        shard_file = shard_database_file(DATABASE_PATH, shard_index, CRAWL_SHARDS)
+        if exit_code != 0:
+            print(f"Shard {shard_index + 1}/{CRAWL_SHARDS} failed with exit code {exit_code}, "
+                  f"keeping {shard_file} to resume it in the next crawl")
+            failed_shards += 1
+            continue
+
+        print(f"Merging shard {shard_index + 1}/{CRAWL_SHARDS} from {shard_file}")
+        writer.flush()
+        with Metrics.phase("merge_shards"):
+            merge_shard(db.conn, shard_file)
+        checkpoint.item_done(SHARDS_PHASE, f"shard-{shard_index}")
+        writer.flush()
+        remove_database_files(shard_file)
+
+    if failed_shards > 0:
+        return False
+    checkpoint.phase_done(SHARDS_PHASE)
+    return True
+
+
+def crawl_shard(shard_index: int) -> None:
+    global db
+    global checkpoint
 
-            except Exception:
-                print(f"An error occurred fetching commits ")
-                traceback.print_exc()
-                print("Continuing")
-                pass
+    create_database(shard_database_file(DATABASE_PATH, shard_index, CRAWL_SHARDS))
+    repo_count = seed_shard(db.conn, DATABASE_FILE, shard_index, CRAWL_SHARDS, CRAWL_SHARD_BY)
+    print(f"Shard {shard_index + 1}/{CRAWL_SHARDS} crawls {repo_count} repositories")
+
+    checkpoint.begin_run(force_full=FORCE_FULL_CRAWL)
+    fetch_repo_branches()
+    fetch_branch_commits()
+    checkpoint.finish_run()
+
+
+def export_metrics() -> None:
+    # Shard processes write next to the files of the main process instead of overwriting them
+    suffix = "" if CRAWL_SHARD_INDEX is None else f".shard-{CRAWL_SHARD_INDEX}"
+    try:
+        if METRICS_FILE:
+            Metrics.write_prometheus(f"{METRICS_FILE}{suffix}")
+        if METRICS_SUMMARY_FILE:
+            Metrics.write_summary(f"{METRICS_SUMMARY_FILE}{suffix}")
+    except OSError:
+        print("An error occurred writing metrics")
+        traceback.print_exc()
+        print("Continuing")
+    Metrics.print_summary()
 
 
 def main():
     global db
 
-    create_database()
-    fetch_repos()
-    fetch_repo_branches()
-    fetch_branch_commits()
+    if METRICS_PORT > 0 and CRAWL_SHARD_INDEX is None:
+        Metrics.serve(METRICS_PORT)
+        print(f"Serving metrics on port {METRICS_PORT}")
+
+    try:
+        crawl()
+    finally:
+        export_metrics()
+
+
+def crawl():
+    global db
+
+    # Shards share the hourly request budget
+    shard_count = CRAWL_SHARDS if CRAWL_SHARD_INDEX is not None else 1
+    configure_validation(DTO_VALIDATION, DTO_VALIDATION_SAMPLE_RATE)
+    print(f"Decoding JSON with {JsonDecoder.configure(JSON_BACKEND)}")
+    ApiFields.configure(enabled=API_FIELD_FILTER)
+    BitbucketClient.configure(
+        pool_size=HTTP_POOL_SIZE,
+        api_url=BITBUCKET_API_URL,
+        scheduler=RequestScheduler(RATE_LIMIT_PER_HOUR, max_retries=REQUEST_MAX_RETRIES,
+                                   max_backoff_s=REQUEST_MAX_BACKOFF_S, share=1 / shard_count),
+        cache=HttpCache(HTTP_CACHE_DIR, HTTP_CACHE_MAX_MB * 1024 * 1024) if HTTP_CACHE_DIR else None
+    )
+
+    if CRAWL_SHARD_INDEX is not None:
+        crawl_shard(int(CRAWL_SHARD_INDEX))
+    else:
+        create_database()
+        checkpoint.begin_run(force_full=FORCE_FULL_CRAWL)
+        fetch_repos()
+        if CRAWL_SHARDS > 1:
+            if not crawl_shards():
+                print("Crawl incomplete, run again to resume the failed shards")
+                BitbucketClient.close()
+                db.close()
+                sys.exit(1)
+        else:
+            fetch_repo_branches()
+            fetch_branch_commits()
+        checkpoint.finish_run()
+
+    if journal_mode_is_wal():
+        # Fold the WAL back into the database file so it does not linger at its peak size
+        checkpoint_wal(db.conn, "TRUNCATE")
 
     print("Done")
+    BitbucketClient.close()
     db.close()
 
 